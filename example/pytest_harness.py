@@ -0,0 +1,50 @@
+"""
+Persistent evaluator for pytest test suites (see :py:class:`pyggi.base.Harness`).
+
+pytest is imported once, then each variant is tested in a forked child,
+which avoids paying the interpreter and pytest startup for every evaluation.
+Usage (program configuration)::
+
+    'harness_command': 'python /path/to/pytest_harness.py -s test_triangle.py'
+"""
+import json
+import os
+import sys
+import tempfile
+
+import pytest
+
+def evaluate(path, args):
+    with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err:
+        pid = os.fork()
+        if pid == 0:
+            return_code = 1
+            try:
+                os.chdir(path)
+                os.dup2(out.fileno(), 1)
+                os.dup2(err.fileno(), 2)
+                return_code = int(pytest.main(list(args)))
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(return_code)
+        _, status = os.waitpid(pid, 0)
+        if os.WIFSIGNALED(status):
+            return_code = -os.WTERMSIG(status)
+        else:
+            return_code = os.WEXITSTATUS(status)
+        out.seek(0)
+        err.seek(0)
+        return return_code, out.read(), err.read()
+
+if __name__ == "__main__":
+    for line in sys.stdin:
+        request = json.loads(line)
+        return_code, stdout, stderr = evaluate(request['path'], sys.argv[1:])
+        reply = {
+            'return_code': return_code,
+            'stdout': stdout.decode(errors='replace'),
+            'stderr': stderr.decode(errors='replace'),
+        }
+        sys.stdout.write(json.dumps(reply) + '\n')
+        sys.stdout.flush()
@@ -27,7 +27,8 @@ class MyProgram(AbstractProgram):
 class MyLineProgram(LineProgram, MyProgram):
     def setup(self, config):
         self.target_files = ["Triangle.java"]
-        self.test_command = "./run.sh"
+        self.test_command = "./run_incremental.sh"
+        self.build_artifacts = {"Triangle.java": ["Triangle.class", "Triangle$*.class"]}
         self.possible_edits = [LineReplacement, LineInsertion, LineDeletion]
 
 class MySrcmlEngine(SrcmlEngine):
@@ -41,7 +42,8 @@ class MySrcmlEngine(SrcmlEngine):
 class MyTreeProgram(MyProgram):
     def setup(self, config):
         self.target_files = ["Triangle.java.xml"]
-        self.test_command = "./run.sh"
+        self.test_command = "./run_incremental.sh"
+        self.build_artifacts = {"Triangle.java.xml": ["Triangle.class", "Triangle$*.class"]}
         self.possible_edits = [StmtReplacement, StmtInsertion, StmtDeletion]
 
     @classmethod
@@ -8,6 +8,7 @@ class Config:
         self.enable_astor = False
         self.log_dir = './pyggi_logs'
         self.work_dir = './pyggi_work'
+        self.cache_dir = './pyggi_cache'
         self.local_original_copy = False
         self.local_original_name = '__original__'
 
@@ -7,6 +7,7 @@ from pyggi.base import Algorithm, Patch
 
 class GeneticProgramming(Algorithm):
     def setup(self):
+        super().setup()
         self.name = 'Genetic Programming'
         self.config['warmup'] = 3
         self.config['horizon'] = 1
@@ -41,6 +42,7 @@ class GeneticProgramming(Algorithm):
         # warmup
         self.hook_warmup()
         empty_patch = Patch()
+        warmup_runs = []
         for i in range(self.config['warmup']+1, 0, -1):
             self.program.base_fitness = None
             self.program.truth_table = {}
@@ -49,6 +51,8 @@ class GeneticProgramming(Algorithm):
             self.hook_warmup_evaluation(l, empty_patch, run)
             if run.status != 'SUCCESS':
                 raise RuntimeError('initial solution has failed')
+            warmup_runs.append(run)
+        self.calibrate_timeout(warmup_runs)
         self.report['initial_fitness'] = run.fitness
         self.report['best_fitness'] = run.fitness
         self.report['best_patch'] = empty_patch
@@ -62,14 +66,18 @@ class GeneticProgramming(Algorithm):
             pop = dict()
             local_best = None
             local_best_fitness = None
-            while len(pop) < self.config['pop_size']:
+            sols = []
+            while len(sols) < self.config['pop_size']:
                 dist = 1 + int(random.random()*self.config['horizon']-1)
                 sol = copy.deepcopy(empty_patch)
                 for _ in range(dist):
                     self.mutate(sol)
-                if sol in pop:
+                sol = sol.canonical()
+                if sol in sols:
                     continue
-                run = self.evaluate_patch(sol)
+                sols.append(sol)
+            # evaluated concurrently by the program workers (see nb_workers)
+            for sol, run in self.evaluate_patches(sols):
                 h = [self.stats['gen'], self.stats['steps']+1, run.status, ' ', run.fitness, sol]
                 if run.status == 'SUCCESS':
                     if self.dominates(run.fitness, local_best_fitness):
@@ -77,8 +85,8 @@ class GeneticProgramming(Algorithm):
                         local_best_fitness = run.fitness
                         local_best = sol
                         h[3] = '+'
-                logger.debug(run)
-                logger.info('{}\t{}\t{}\t{}{}\t{}'.format(*h))
+                self.program.logger.debug(run)
+                self.program.logger.info('{}\t{}\t{}\t{}{}\t{}'.format(*h))
                 pop[sol] = run
                 self.stats['steps'] += 1
 
@@ -112,6 +120,7 @@ class GeneticProgramming(Algorithm):
                     sol = copy.deepcopy(empty_patch)
                     for _ in range(dist):
                         self.mutate(sol)
+                    sol = sol.canonical()
                     if sol in pop:
                         continue
                     offsprings.append(sol)
@@ -132,21 +141,25 @@ class GeneticProgramming(Algorithm):
                 pop.clear()
                 local_best = None
                 local_best_fitness = None
-                for sol in offsprings:
-                    if self.stopping_condition():
-                        break
-                    run = self.evaluate_patch(sol)
-                    h = [self.stats['gen']+1, self.stats['steps']+1, run.status, ' ', run.fitness, sol]
-                    if run.status == 'SUCCESS':
-                        if self.dominates(run.fitness, local_best_fitness):
-                            self.program.logger.debug(self.program.diff(sol))
-                            local_best = sol
-                            local_best_fitness = run.fitness
-                            h[3] = '+'
-                    logger.debug(run)
-                    logger.info('{}\t{}\t{}\t{}{}\t{}'.format(*h))
-                    pop[sol] = run
-                    self.stats['steps'] += 1
+                evaluations = self.evaluate_patches(offsprings)
+                try:
+                    for sol, run in evaluations:
+                        h = [self.stats['gen']+1, self.stats['steps']+1, run.status, ' ', run.fitness, sol]
+                        if run.status == 'SUCCESS':
+                            if self.dominates(run.fitness, local_best_fitness):
+                                self.program.logger.debug(self.program.diff(sol))
+                                local_best = sol
+                                local_best_fitness = run.fitness
+                                h[3] = '+'
+                        self.program.logger.debug(run)
+                        self.program.logger.info('{}\t{}\t{}\t{}{}\t{}'.format(*h))
+                        pop[sol.canonical()] = run
+                        self.stats['steps'] += 1
+                        if self.stopping_condition():
+                            break
+                finally:
+                    # cancels the pending evaluations
+                    evaluations.close()
                 if local_best is not None:
                     self.report['best_fitness'] = local_best_fitness
                     self.report['best_patch'] = local_best
@@ -44,6 +44,7 @@ class LocalSearch(Algorithm):
         empty_patch = Patch()
         if self.report['initial_patch'] is None:
             self.report['initial_patch'] = empty_patch
+        warmup_runs = []
         for i in range(self.config['warmup']+1, 0, -1):
             self.program.base_fitness = None
             self.program.truth_table = {}
@@ -54,6 +55,8 @@ class LocalSearch(Algorithm):
             if run.status != 'SUCCESS':
                 raise RuntimeError('initial solution has failed')
             current_fitness = run.fitness
+            warmup_runs.append(run)
+        self.calibrate_timeout(warmup_runs)
         self.report['initial_fitness'] = current_fitness
         if self.report['best_patch'] is None:
             self.report['best_fitness'] = current_fitness
@@ -77,12 +80,17 @@ class LocalSearch(Algorithm):
         try:
             # main loop
             current_patch = self.report['best_patch']
+            self.program.set_current(current_patch)
             while not self.stopping_condition():
                 self.hook_main_loop()
-                current_patch, current_fitness = self.explore(current_patch, current_fitness)
+                new_patch, current_fitness = self.explore(current_patch, current_fitness)
+                if new_patch is not current_patch:
+                    self.program.set_current(new_patch)
+                    current_patch = new_patch
 
         finally:
             # the end
+            self.program.set_current(None)
             self.hook_end()
 
     def mutate(self, patch, force=None):
@@ -237,7 +245,7 @@ class FirstImprovement(LocalSearch):
         while True:
             patch = copy.deepcopy(current_patch)
             self.mutate(patch)
-            if patch not in self.local_tabu:
+            if patch.canonical() not in self.local_tabu:
                 break
 
         # compare
@@ -259,7 +267,7 @@ class FirstImprovement(LocalSearch):
             self.stats['neighbours'] = 0
         else:
             if len(patch) < len(current_patch):
-                self.local_tabu.add(patch)
+                self.local_tabu.add(patch.canonical())
             self.stats['neighbours'] += 1
             self.check_if_trapped()
 
@@ -285,7 +293,7 @@ class BestImprovement(LocalSearch):
         while True:
             patch = copy.deepcopy(current_patch)
             self.mutate(patch)
-            if patch not in self.local_tabu:
+            if patch.canonical() not in self.local_tabu:
                 break
 
         # compare
@@ -315,7 +323,7 @@ class BestImprovement(LocalSearch):
                 self.check_if_trapped()
         else:
             if len(patch) < len(current_patch):
-                self.local_tabu.add(patch)
+                self.local_tabu.add(patch.canonical())
             self.stats['neighbours'] += 1
             self.check_if_trapped()
 
@@ -341,7 +349,7 @@ class WorstImprovement(LocalSearch):
         while True:
             patch = copy.deepcopy(current_patch)
             self.mutate(patch)
-            if patch not in self.local_tabu:
+            if patch.canonical() not in self.local_tabu:
                 break
 
         # compare
@@ -371,7 +379,7 @@ class WorstImprovement(LocalSearch):
                 self.check_if_trapped()
         else:
             if len(patch) < len(current_patch):
-                self.local_tabu.add(patch)
+                self.local_tabu.add(patch.canonical())
             self.stats['neighbours'] += 1
             self.check_if_trapped()
 
@@ -396,7 +404,8 @@ class TabuSearch(BestImprovement):
         while True:
             patch = copy.deepcopy(current_patch)
             self.mutate(patch)
-            if patch not in self.tabu_list and patch not in self.local_tabu:
+            canonical = patch.canonical()
+            if canonical not in self.tabu_list and canonical not in self.local_tabu:
                 break
 
         # compare
@@ -421,14 +430,14 @@ class TabuSearch(BestImprovement):
                 self.local_best_fitness = None
                 self.local_tabu.clear()
                 self.stats['neighbours'] = 0
-                self.tabu_list.append(self.local_best_patch)
+                self.tabu_list.append(current_patch.canonical())
                 while len(self.tabu_list) >= self.config['tabu_length']:
                     self.tabu_list.pop(0)
             else:
                 self.check_if_trapped()
         else:
             if len(patch) < len(current_patch):
-                self.local_tabu.add(patch)
+                self.local_tabu.add(patch.canonical())
             self.stats['neighbours'] += 1
             self.check_if_trapped()
 
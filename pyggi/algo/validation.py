@@ -10,13 +10,12 @@ from . import LocalSearch
 class ValidSearch(LocalSearch):
     def clean_patch(self, patch):
         cleaned = copy.deepcopy(patch)
-        cleaned_diff = self.program.diff(cleaned)
+        cleaned_key = self.program.variant_key(cleaned)
         for (k,edit) in reversed(list(enumerate(cleaned.edit_list))):
             tmp = copy.deepcopy(cleaned)
             del tmp.edit_list[k]
-            if self.program.diff(tmp) == cleaned_diff:
+            if self.program.variant_key(tmp) == cleaned_key:
                 del cleaned.edit_list[k]
-                cleaned_diff = self.program.diff(cleaned)
         return cleaned
 
 class ValidSingle(ValidSearch):
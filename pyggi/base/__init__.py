@@ -2,5 +2,7 @@ from .edit import AbstractEdit
 from .patch import Patch
 from .runresult import RunResult
 from .engine import AbstractEngine
+from .harness import Harness
+from .cache import SqliteCache, SharedCache, LRUCache, LFUCache
 from .program import AbstractProgram
 from .algorithm import Algorithm
@@ -1,8 +1,14 @@
 from abc import ABC, abstractmethod
+import asyncio
 import itertools
+import os
 import random
+import statistics
 import time
 
+from .. import config as pyggi_config
+from .cache import SqliteCache, SharedCache, LRUCache, LFUCache
+
 class Algorithm(ABC):
     def __init__(self):
         self.setup()
@@ -10,13 +16,21 @@ class Algorithm(ABC):
     def setup(self):
         self.config = {}
         self.config['cache'] = True
-        self.config['cache_maxsize'] = 40
-        self.config['cache_keep'] = 0.2
+        self.config['cache_policy'] = 'lfu' # 'lfu' or 'lru'
+        self.config['cache_maxsize'] = 40 # entries (None: unbounded)
+        self.config['cache_maxbytes'] = None # estimated size in bytes (None: unbounded)
+        self.config['shared_cache'] = False # True (within pyggi.config.cache_dir) or path
+        self.config['disk_cache'] = False # True (within pyggi.config.cache_dir) or path
+        self.config['timeout_factor'] = None # multiple of the median warmup time
+        self.config['timeout_min'] = 1 # seconds
+        self.config['timeout_max'] = None # seconds
         self.stop = {}
         self.stop['wall'] = None # seconds
         self.stop['steps'] = None
         self.stop['budget'] = None
         self.stop['fitness'] = None
+        self.shared_cache = None
+        self.disk_cache = None
         self.reset()
 
 
@@ -24,13 +38,18 @@ class Algorithm(ABC):
         self.stats = {}
         self.stats['cache_hits'] = 0
         self.stats['cache_misses'] = 0
+        self.stats['shared_cache_hits'] = 0
+        self.stats['disk_cache_hits'] = 0
+        self.stats['cache_evictions'] = 0
         self.stats['budget'] = 0
+        self.stats['timeouts'] = 0
         self.report = {}
         self.report['initial_patch'] = None
         self.report['initial_fitness'] = None
         self.report['best_fitness'] = None
         self.report['best_patch'] = None
         self.report['stop'] = None
+        self.report['timeout'] = None
         self.cache_reset()
 
     @abstractmethod
@@ -48,52 +67,209 @@ class Algorithm(ABC):
         self.stats['wallclock_end'] = time.time()
         self.program.logger.info('==== END ====')
         self.program.logger.info('Reason: {}'.format(self.report['stop']))
+        self.program.logger.info('Timeouts: {}'.format(self.stats['timeouts']))
+
+    def calibrate_timeout(self, runs):
+        """
+        Set the timeout of the program to *timeout_factor* times the median
+        elapsed time of the given (warmup) runs, within [*timeout_min*, *timeout_max*].
+        Does nothing if *timeout_factor* is None.
+        """
+        if self.config['timeout_factor'] is None:
+            return
+        times = [run.elapsed_time for run in runs if getattr(run, 'elapsed_time', None) is not None]
+        if not times:
+            return
+        median = statistics.median(times)
+        timeout = self.config['timeout_factor'] * median
+        if self.config['timeout_min'] is not None:
+            timeout = max(timeout, self.config['timeout_min'])
+        if self.config['timeout_max'] is not None:
+            timeout = min(timeout, self.config['timeout_max'])
+        self.program.timeout = timeout
+        self.report['timeout'] = timeout
+        self.program.logger.info('Timeout: {}s (median: {}s)'.format(round(timeout, 3), round(median, 3)))
 
     def evaluate_patch(self, patch, force=False, forget=False):
-        diff = None
-        if self.config['cache'] and not force:
-            diff = self.program.diff(patch)
-            run = self.cache_get(diff)
-            if run:
-                return run
+        key = None
+        if self.config['cache']:
+            key = self.program.variant_key(patch)
+            if not force:
+                run = self.cache_get(key)
+                if run:
+                    return run
         run = self.program.evaluate_patch(patch)
-        if self.config['cache'] and not forget:
-            if not diff:
-                diff = self.program.diff(patch)
-            self.cache_set(diff, run)
+        if key is not None and not forget:
+            self.cache_set(key, run)
         self.stats['budget'] += getattr(run, 'budget', 0) or 0
+        if run.status == 'TIMEOUT':
+            self.stats['timeouts'] += 1
         return run
 
-    def cache_get(self, diff):
+    def evaluate_patches(self, patches, force=False, forget=False):
+        patches = list(patches)
+        # the dumps built for the keys are reused by the evaluations
+        # only if they are still memoized by then
+        memo_size = self.program.dumps_memo_size
+        self.program.dumps_memo_size = max(memo_size, len(patches))
         try:
-            run = self.cache[diff]
+            todo = []
+            keys = {}
+            for patch in patches:
+                if self.config['cache']:
+                    key = self.program.variant_key(patch)
+                    if not force:
+                        run = self.cache_get(key)
+                        if run:
+                            yield (patch, run)
+                            continue
+                    keys[id(patch)] = key
+                todo.append(patch)
+            for patch, run in self.program.evaluate_patches(todo):
+                if self.config['cache'] and not forget:
+                    self.cache_set(keys[id(patch)], run)
+                self.stats['budget'] += getattr(run, 'budget', 0) or 0
+                if run.status == 'TIMEOUT':
+                    self.stats['timeouts'] += 1
+                yield (patch, run)
+        finally:
+            self.program.dumps_memo_size = memo_size
+
+    async def async_evaluate_patch(self, patch, force=False, forget=False):
+        """
+        Coroutine version of :py:meth:`evaluate_patch`, for callers that
+        drive their own asyncio event loop (the algorithms themselves use
+        :py:meth:`evaluate_patches`). Variants are built in the default
+        executor, so as not to block the event loop.
+        """
+        key = None
+        if self.config['cache']:
+            loop = asyncio.get_event_loop()
+            key = await loop.run_in_executor(None, self.program.variant_key, patch)
+            if not force:
+                run = self.cache_get(key)
+                if run:
+                    return run
+        run = await self.program.async_evaluate_patch(patch)
+        if key is not None and not forget:
+            self.cache_set(key, run)
+        self.stats['budget'] += getattr(run, 'budget', 0) or 0
+        if run.status == 'TIMEOUT':
+            self.stats['timeouts'] += 1
+        return run
+
+    async def async_evaluate_patches(self, patches, force=False, forget=False):
+        patches = list(patches)
+        runs = await asyncio.gather(*[self.async_evaluate_patch(patch, force, forget) for patch in patches])
+        return list(zip(patches, runs))
+
+    def cache_get(self, key):
+        run = self.get_cache().get(key)
+        if run:
             self.stats['cache_hits'] += 1
-            if self.config['cache_maxsize'] > 0:
-                self.cache_hits[diff] += 1
             return run
-        except KeyError:
-            self.stats['cache_misses'] += 1
+        backends = self.get_cache_backends()
+        if backends:
+            namespace = self.program.cache_namespace()
+            for i, (name, backend) in enumerate(backends):
+                run = backend.get(namespace, key)
+                if run and run.status != 'TIMEOUT': # e.g., stored by an older version
+                    self.stats['cache_hits'] += 1
+                    self.stats['{}_hits'.format(name)] += 1
+                    for _, faster_backend in backends[:i]:
+                        faster_backend.set(namespace, key, run)
+                    self.cache_set(key, run, persist=False)
+                    return run
+        self.stats['cache_misses'] += 1
+        return None
+
+    def cache_set(self, key, run, persist=True):
+        # timeouts depend on the (calibrated) timeout of this run: not shared
+        if persist and run.status != 'TIMEOUT':
+            backends = self.get_cache_backends()
+            if backends:
+                namespace = self.program.cache_namespace()
+                for _, backend in backends:
+                    backend.set(namespace, key, run)
+        cache = self.get_cache()
+        evictions = cache.evictions
+        cache.set(key, run)
+        self.stats['cache_evictions'] += cache.evictions - evictions
+
+    def get_cache_backends(self):
+        """
+        :return: The enabled caches shared with other algorithms,
+          from the fastest to the slowest, with their names
+        :rtype: list(tuple(str, :py:class:`.SharedCache` or :py:class:`.SqliteCache`))
+        """
+        backends = []
+        shared_cache = self.get_shared_cache()
+        if shared_cache is not None:
+            backends.append(('shared_cache', shared_cache))
+        disk_cache = self.get_disk_cache()
+        if disk_cache is not None:
+            backends.append(('disk_cache', disk_cache))
+        return backends
+
+    def get_cache(self):
+        """
+        :return: The in-memory cache, created on first use
+          according to the *cache_policy*, *cache_maxsize*, and *cache_maxbytes* options
+        :rtype: :py:class:`.LRUCache` or :py:class:`.LFUCache`
+        """
+        if self.cache is None:
+            policies = {'lru': LRUCache, 'lfu': LFUCache}
+            try:
+                klass = policies[self.config['cache_policy']]
+            except KeyError:
+                raise ValueError('unknown cache policy: {}'.format(self.config['cache_policy']))
+            maxsize = self.config['cache_maxsize'] or None
+            self.cache = klass(maxsize, self.config['cache_maxbytes'])
+        return self.cache
+
+    def get_shared_cache(self):
+        """
+        :return: The cache shared with all the local processes, if enabled
+          (see *shared_cache* option)
+        :rtype: :py:class:`.SharedCache`
+        """
+        path = self.config['shared_cache']
+        if not path:
             return None
+        if path is True:
+            path = os.path.join(pyggi_config.cache_dir, 'shared.cache')
+        if self.shared_cache is None or self.shared_cache.path != path:
+            self.shared_cache = SharedCache(path)
+        return self.shared_cache
 
-    def cache_set(self, diff, run):
-        msize = self.config['cache_maxsize']
-        if msize > 0 and len(self.cache_hits) > msize:
-            keep = self.config['cache_keep']
-            hits = sorted(self.cache.keys(), key=lambda k: 999 if len(k) == 0 else self.cache_hits[k])
-            for k in hits[:int(msize*(1-keep))]:
-                del self.cache[k]
-            self.cache_hits = { p: 0 for p in self.cache.keys()}
-        if not diff in self.cache:
-            self.cache_hits[diff] = 0
-        self.cache[diff] = run
+    def get_disk_cache(self):
+        """
+        :return: The persistent cache shared by epochs and runs, if enabled
+          (see *disk_cache* option)
+        :rtype: :py:class:`.SqliteCache`
+        """
+        path = self.config['disk_cache']
+        if not path:
+            return None
+        if path is True:
+            path = os.path.join(pyggi_config.cache_dir, 'runs.sqlite')
+        if self.disk_cache is None or self.disk_cache.path != path:
+            self.disk_cache = SqliteCache(path)
+        return self.disk_cache
 
     def cache_copy(self, algo):
-        self.cache = algo.cache
-        self.cache_hits = algo.cache_hits
+        """
+        Share the caches of *algo*: the in-memory cache is aliased, and its
+        shared and disk caches (if any) are also used by this algorithm.
+        """
+        self.cache = algo.get_cache()
+        self.config['shared_cache'] = algo.config['shared_cache']
+        self.config['disk_cache'] = algo.config['disk_cache']
+        self.shared_cache = algo.shared_cache
+        self.disk_cache = algo.disk_cache
 
     def cache_reset(self):
-        self.cache = {}
-        self.cache_hits = {}
+        self.cache = None
 
     def dominates(self, fit1, fit2):
         if fit1 is None:
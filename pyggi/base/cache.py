@@ -0,0 +1,387 @@
+from abc import ABC, abstractmethod
+import collections
+import fcntl
+import hashlib
+import mmap
+import os
+import pickle
+import sqlite3
+import struct
+import threading
+import time
+
+class SqliteCache:
+    """
+    SqliteCache is a persistent cache of run results, stored in a SQLite database.
+    Results are identified by a namespace (e.g., the test command and instances)
+    and a key (e.g., a hash of the variant source code).
+
+    The database is opened in WAL mode, so that several processes
+    (e.g., parallel runs on a same program) can read and write it concurrently;
+    a locked database is retried for up to *timeout* seconds.
+    """
+    def __init__(self, path, timeout=30):
+        self.path = path
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.connection = None
+
+    def connect(self):
+        if self.connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.connection = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS runs ('
+                                    'namespace TEXT, key TEXT, run BLOB, time REAL, '
+                                    'PRIMARY KEY (namespace, key))')
+            self.connection.commit()
+        return self.connection
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def get(self, namespace, key):
+        """
+        :return: The cached run result, or None
+        :rtype: :py:class:`.RunResult`
+        """
+        with self.lock:
+            row = self.connect().execute('SELECT run FROM runs WHERE namespace = ? AND key = ?',
+                                         (namespace, key)).fetchone()
+        if row is None:
+            return None
+        try:
+            return pickle.loads(row[0])
+        except Exception: # e.g., class removed since then
+            return None
+
+    def set(self, namespace, key, run):
+        data = pickle.dumps(run, pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                connection.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?)',
+                                   (namespace, key, data, time.time()))
+
+    def clear(self, namespace=None):
+        with self.lock:
+            connection = self.connect()
+            with connection:
+                if namespace is None:
+                    connection.execute('DELETE FROM runs')
+                else:
+                    connection.execute('DELETE FROM runs WHERE namespace = ?', (namespace,))
+
+    def __len__(self):
+        with self.lock:
+            return self.connect().execute('SELECT COUNT(*) FROM runs').fetchone()[0]
+
+
+class SharedCache:
+    """
+    SharedCache is a cache of run results shared by all the local processes
+    using the same file *path*: a fixed-size open-addressing hash table of
+    *nb_slots* slots of *slot_size* bytes, memory-mapped by each process and
+    protected by *flock*. Run results whose pickle does not fit a slot are not
+    cached, and the last of *max_probes* probed slots is overwritten when full.
+
+    Only the path and the geometry of the table are pickled,
+    so that it can be passed to other processes (e.g., multiprocessing).
+    """
+    MAGIC = b'PYGGISC1'
+    HEADER = struct.Struct('<8sII')
+    SLOT_HEADER = struct.Struct('<20sI')
+    EMPTY = bytes(20)
+
+    def __init__(self, path, nb_slots=1 << 16, slot_size=512, max_probes=16):
+        self.path = path
+        self.nb_slots = nb_slots
+        self.slot_size = slot_size
+        self.max_probes = max_probes
+        self.lock = threading.Lock()
+        self.file = None
+        self.map = None
+
+    def __getstate__(self):
+        return {k: self.__dict__[k] for k in ['path', 'nb_slots', 'slot_size', 'max_probes']}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def open(self):
+        if self.map is not None:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.file = os.fdopen(fd, 'r+b')
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size == 0:
+                os.ftruncate(fd, self.HEADER.size + self.nb_slots*self.slot_size)
+                os.pwrite(fd, self.HEADER.pack(self.MAGIC, self.nb_slots, self.slot_size), 0)
+            else:
+                magic, self.nb_slots, self.slot_size = self.HEADER.unpack(os.pread(fd, self.HEADER.size, 0))
+                if magic != self.MAGIC:
+                    raise ValueError('not a shared cache: {}'.format(self.path))
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self.map = mmap.mmap(fd, 0)
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.file.close()
+                self.map = None
+                self.file = None
+
+    def probe(self, digest):
+        start = int.from_bytes(digest[:8], 'little')
+        for i in range(self.max_probes):
+            yield self.HEADER.size + ((start + i) % self.nb_slots) * self.slot_size
+
+    def digest(self, namespace, key):
+        return hashlib.sha1('{}\0{}'.format(namespace, key).encode()).digest()
+
+    def get(self, namespace, key):
+        """
+        :return: The cached run result, or None
+        :rtype: :py:class:`.RunResult`
+        """
+        digest = self.digest(namespace, key)
+        data = None
+        with self.lock:
+            self.open()
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_SH)
+            try:
+                for offset in self.probe(digest):
+                    slot_digest, size = self.SLOT_HEADER.unpack_from(self.map, offset)
+                    if slot_digest == digest:
+                        start = offset + self.SLOT_HEADER.size
+                        data = self.map[start:start+size]
+                        break
+                    if slot_digest == self.EMPTY:
+                        break
+            finally:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        if data is None:
+            return None
+        try:
+            return pickle.loads(data)
+        except Exception:
+            return None
+
+    def set(self, namespace, key, run):
+        """
+        :return: Whether the run result fits in a slot (and was cached)
+        :rtype: bool
+        """
+        digest = self.digest(namespace, key)
+        data = pickle.dumps(run, pickle.HIGHEST_PROTOCOL)
+        if self.SLOT_HEADER.size + len(data) > self.slot_size:
+            return False
+        with self.lock:
+            self.open()
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+            try:
+                for offset in self.probe(digest):
+                    slot_digest, _ = self.SLOT_HEADER.unpack_from(self.map, offset)
+                    if slot_digest in [digest, self.EMPTY]:
+                        break
+                start = offset + self.SLOT_HEADER.size
+                self.map[start:start+len(data)] = data
+                self.SLOT_HEADER.pack_into(self.map, offset, digest, len(data))
+            finally:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        return True
+
+    def __len__(self):
+        with self.lock:
+            self.open()
+            count = 0
+            for slot in range(self.nb_slots):
+                offset = self.HEADER.size + slot*self.slot_size
+                if self.map[offset:offset+20] != self.EMPTY:
+                    count += 1
+            return count
+
+
+class AbstractMemoryCache(ABC):
+    """
+    In-memory cache of run results, bounded by a number of entries (*maxsize*)
+    and/or an estimated size in bytes (*maxbytes*), None meaning unbounded.
+    Entries are evicted one by one, in constant time, according to the policy
+    of the subclass; *evictions* counts them.
+    """
+    def __init__(self, maxsize=None, maxbytes=None):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.evictions = 0
+        self.clear()
+
+    def clear(self):
+        self.sizes = {}
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __contains__(self, key):
+        return key in self.sizes
+
+    @staticmethod
+    def sizeof(key, value):
+        return len(key) + len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    @abstractmethod
+    def get(self, key):
+        """
+        :return: The cached value (None on miss)
+        """
+        pass
+
+    @abstractmethod
+    def insert(self, key, value):
+        """
+        Store a new entry (the room is already made)
+        """
+        pass
+
+    @abstractmethod
+    def update(self, key, value):
+        """
+        Replace the value of an existing entry
+        """
+        pass
+
+    @abstractmethod
+    def pop_victim(self):
+        """
+        Remove the next entry to evict according to the policy
+
+        :return: Its key
+        """
+        pass
+
+    def set(self, key, value):
+        size = self.sizeof(key, value) if self.maxbytes is not None else 0
+        if key in self.sizes:
+            self.nbytes += size - self.sizes[key]
+            self.sizes[key] = size
+            self.update(key, value)
+            while len(self.sizes) > 1 and self.is_full(0, 0):
+                self.evict()
+        else:
+            # evicts first, so that the new entry is kept
+            while self.sizes and self.is_full(1, size):
+                self.evict()
+            self.nbytes += size
+            self.sizes[key] = size
+            self.insert(key, value)
+
+    def is_full(self, extra_entries, extra_bytes):
+        if self.maxsize is not None and len(self.sizes) + extra_entries > self.maxsize:
+            return True
+        if self.maxbytes is not None and self.nbytes + extra_bytes > self.maxbytes:
+            return True
+        return False
+
+    def evict(self):
+        key = self.pop_victim()
+        self.nbytes -= self.sizes.pop(key)
+        self.evictions += 1
+
+
+class LRUCache(AbstractMemoryCache):
+    """
+    Least-recently-used eviction policy
+    """
+    def clear(self):
+        super().clear()
+        self.data = collections.OrderedDict()
+
+    def get(self, key):
+        try:
+            self.data.move_to_end(key)
+            return self.data[key]
+        except KeyError:
+            return None
+
+    def insert(self, key, value):
+        self.data[key] = value
+
+    def update(self, key, value):
+        self.data[key] = value
+        self.data.move_to_end(key)
+
+    def pop_victim(self):
+        key, _ = self.data.popitem(last=False)
+        return key
+
+
+class LFUCache(AbstractMemoryCache):
+    """
+    Least-frequently-used eviction policy with dynamic aging (LFU-DA):
+    the priority of an entry is its number of hits plus the priority of the
+    last evicted entry when it was inserted, so that entries that were hit
+    a lot long ago are eventually evicted.
+    Entries of same priority are evicted in least-recently-used order.
+    """
+    def clear(self):
+        super().clear()
+        self.data = {}
+        self.priorities = {}
+        self.buckets = {} # priority -> ordered keys
+        self.age = 0
+        self.min_priority = 0
+
+    def get(self, key):
+        try:
+            value = self.data[key]
+        except KeyError:
+            return None
+        self.move(key, self.priorities[key] + 1)
+        return value
+
+    def move(self, key, priority):
+        old = self.priorities[key]
+        bucket = self.buckets[old]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[old]
+            if self.min_priority == old:
+                self.min_priority = priority
+        self.add(key, priority)
+
+    def add(self, key, priority):
+        self.priorities[key] = priority
+        self.buckets.setdefault(priority, collections.OrderedDict())[key] = None
+        if len(self.priorities) == 1 or priority < self.min_priority:
+            self.min_priority = priority
+
+    def insert(self, key, value):
+        self.data[key] = value
+        self.add(key, self.age + 1)
+
+    def update(self, key, value):
+        self.data[key] = value
+        self.move(key, self.priorities[key] + 1)
+
+    def pop_victim(self):
+        while self.min_priority not in self.buckets:
+            self.min_priority += 1 # amortized by the growth of priorities
+        bucket = self.buckets[self.min_priority]
+        key, _ = bucket.popitem(last=False)
+        if not bucket:
+            del self.buckets[self.min_priority]
+        self.age = self.priorities.pop(key)
+        del self.data[key]
+        return key
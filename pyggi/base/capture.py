@@ -0,0 +1,40 @@
+import collections
+
+class OutputCapture:
+    """
+    OutputCapture accumulates the output of a child process.
+    Only the last *max_size* bytes are kept in memory (ring buffer),
+    the whole stream being optionally copied to the file *spill_path*.
+    """
+    def __init__(self, max_size=None, spill_path=None):
+        self.max_size = max_size
+        self.spill_path = spill_path
+        self.spill_file = open(spill_path, 'wb') if spill_path else None
+        self.chunks = collections.deque()
+        self.size = 0 # bytes currently buffered
+        self.total = 0 # bytes received so far
+
+    def write(self, data):
+        self.total += len(data)
+        if self.spill_file:
+            self.spill_file.write(data)
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.max_size is not None:
+            while self.size > self.max_size:
+                extra = self.size - self.max_size
+                head = self.chunks[0]
+                if len(head) <= extra:
+                    self.chunks.popleft()
+                    self.size -= len(head)
+                else:
+                    self.chunks[0] = head[extra:]
+                    self.size -= extra
+
+    def getvalue(self):
+        return b''.join(self.chunks)
+
+    def close(self):
+        if self.spill_file:
+            self.spill_file.close()
+            self.spill_file = None
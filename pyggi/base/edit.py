@@ -22,3 +22,32 @@ class AbstractEdit(ABC):
     @abstractmethod
     def apply(self, program, new_contents, new_locations):
         pass
+
+    def touched_files(self):
+        """
+        :return: The files modified by this edit
+        :rtype: set(str)
+        """
+        return {self.target[0]}
+
+    def overwrites(self, other):
+        """
+        :return: Whether applying this edit after *other* (possibly with other
+          edits in between) discards the effect of *other*
+        :rtype: bool
+        """
+        return False
+
+    def is_noop(self):
+        """
+        :return: Whether this edit does nothing once the edits it overwrites are dropped
+        :rtype: bool
+        """
+        return False
+
+    def sort_key(self):
+        """
+        :return: A key such that edits of a same file with distinct keys commute,
+          or None if this edit may not commute with other edits of its file
+        """
+        return None
@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+import os
 
 class AbstractEngine(ABC):
     @classmethod
@@ -6,6 +7,16 @@ class AbstractEngine(ABC):
     def get_contents(cls, file_path):
         pass
 
+    @classmethod
+    def get_contents_batch(cls, file_paths):
+        """
+        Get the contents of several files at once (e.g., to share the cost
+        of an external parser); by default, one by one
+
+        :rtype: list
+        """
+        return [cls.get_contents(file_path) for file_path in file_paths]
+
     @classmethod
     @abstractmethod
     def get_modification_points(cls, contents_of_file):
@@ -13,11 +24,38 @@ class AbstractEngine(ABC):
 
     @classmethod
     def write_to_tmp_dir(cls, contents_of_file, tmp_path):
-        with open(tmp_path, 'w') as tmp_file:
-            tmp_file.write(cls.dump(contents_of_file))
+        cls.write_dump_to_tmp_dir(cls.dump(contents_of_file), tmp_path)
+
+    @classmethod
+    def write_dump_to_tmp_dir(cls, dump, tmp_path):
+        try:
+            stat = os.stat(tmp_path)
+        except FileNotFoundError:
+            stat = None
+        # written aside then renamed, so that hard-linked files are never modified
+        new_path = '{}.pyggi_tmp'.format(tmp_path)
+        with open(new_path, 'w') as tmp_file:
+            tmp_file.write(dump)
+        if stat is not None:
+            os.chmod(new_path, stat.st_mode & 0o7777)
+            # timestamp-based caches (e.g., Python bytecode) must notice the change
+            if int(os.stat(new_path).st_mtime) <= int(stat.st_mtime):
+                mtime = int(stat.st_mtime)+1
+                os.utime(new_path, (mtime, mtime))
+        os.replace(new_path, tmp_path)
 
     @classmethod
     @abstractmethod
     def dump(cls, contents_of_file):
         pass
 
+    @classmethod
+    def validate_dump(cls, dump, file_name):
+        """
+        Cheap in-process check of a dumped file (see *validate* program option)
+
+        :return: Whether the file may be valid (default: True)
+        :rtype: bool
+        """
+        return True
+
@@ -0,0 +1,106 @@
+import json
+import os
+import selectors
+import signal
+import subprocess
+import time
+
+class Harness:
+    """
+    Harness encapsulates a long-lived evaluator process.
+    It is started once, then receives one JSON request per line on its stdin::
+
+        {"path": "/path/to/variant", "timeout": 15}
+
+    and must answer each request with one JSON line on its stdout::
+
+        {"return_code": 0, "stdout": "...", "stderr": "..."}
+
+    The evaluator is killed on timeout and (re)started on the next request
+    whenever it is not running (e.g., after a crash).
+    It runs in its own session.
+    """
+    def __init__(self, cmd, cwd=None, env=None, log_path=None):
+        self.cmd = cmd
+        self.cwd = cwd
+        self.env = env
+        self.log_path = log_path
+        self.process = None
+        self.pgid = None
+        self.buffer = b''
+
+    def __del__(self):
+        self.stop()
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        self.stop()
+        log_file = open(self.log_path, 'ab') if self.log_path else subprocess.DEVNULL
+        try:
+            self.process = subprocess.Popen(self.cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=log_file, start_new_session=True, cwd=self.cwd, env=self.env)
+        finally:
+            if self.log_path:
+                log_file.close()
+        self.buffer = b''
+        # kept, as the process may be reaped (e.g., by poll) before stop
+        self.pgid = os.getpgid(self.process.pid)
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            os.killpg(self.pgid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.process.wait()
+        self.process.stdin.close()
+        self.process.stdout.close()
+        self.process = None
+
+    def evaluate(self, path, timeout=15):
+        """
+        :return: The return code (None on timeout), stdout, stderr, and elapsed time
+        :rtype: tuple(int, bytes, bytes, float)
+        """
+        if not self.is_running():
+            self.start()
+        start = time.time()
+        request = json.dumps({'path': path, 'timeout': timeout})
+        try:
+            self.process.stdin.write(request.encode() + b'\n')
+            self.process.stdin.flush()
+            line = self.read_line(start + timeout)
+        except BrokenPipeError:
+            line = b''
+        end = time.time()
+        if line is None: # timeout
+            self.stop()
+            return (None, b'', b'', end-start)
+        try:
+            reply = json.loads(line.decode())
+            return (reply['return_code'],
+                    reply.get('stdout', '').encode(),
+                    reply.get('stderr', '').encode(),
+                    end-start)
+        except (ValueError, KeyError, TypeError):
+            # crashed or invalid reply: restarted on next request
+            return_code = self.process.poll()
+            self.stop()
+            return (-1 if return_code is None else return_code, line, b'', end-start)
+
+    def read_line(self, deadline):
+        fd = self.process.stdout.fileno()
+        with selectors.DefaultSelector() as selector:
+            selector.register(fd, selectors.EVENT_READ)
+            while b'\n' not in self.buffer:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not selector.select(remaining):
+                    return None
+                data = os.read(fd, 1 << 16)
+                if not data:
+                    return b''
+                self.buffer += data
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        return line
@@ -0,0 +1,30 @@
+"""
+Exec wrapper applying a CPU affinity and resource limits (see
+:py:meth:`pyggi.base.AbstractProgram.limit_command`)::
+
+    python -S limits.py '[[0, 1], [[7, [256, 256]]]]' cmd arg...
+
+The limits are set in the process itself, which then executes *cmd*,
+so that every process *cmd* starts inherits them.
+Only the standard library is imported, to keep the startup short.
+"""
+import json
+import os
+import resource
+import sys
+
+def main(argv):
+    cpu_set, limits = json.loads(argv[1])
+    if cpu_set is not None:
+        os.sched_setaffinity(0, cpu_set)
+    for rlimit, value in limits:
+        resource.setrlimit(rlimit, tuple(value))
+    try:
+        os.execvp(argv[2], argv[2:])
+    except OSError as error:
+        sys.stderr.write('{}: {}\n'.format(argv[2], error))
+        sys.stderr.flush()
+        os._exit(127)
+
+if __name__ == "__main__":
+    main(sys.argv)
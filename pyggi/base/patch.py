@@ -42,6 +42,41 @@ class Patch:
         """
         return Patch(deepcopy(self.edit_list))
 
+    def canonical(self):
+        """
+        Create an equivalent patch (i.e., leading to the same variant) in canonical form:
+        overwritten and no-op edits are dropped, and commuting edits are sorted
+        (see *overwrites*, *is_noop*, and *sort_key* of :py:class:`.base.AbstractEdit`),
+        unless some edit has no *sort_key*; edits are grouped by file in any case.
+        Edits are shared with the current patch.
+
+        :return: The canonical patch
+        :rtype: :py:class:`.Patch`
+        """
+        if any(edit.sort_key() is None for edit in self.edit_list):
+            # edits of unknown effect (e.g., a line moving also deletes its
+            # ingredient) may make later no-op or overwriting edits relevant
+            edits = list(self.edit_list)
+        else:
+            edits = []
+            for edit in self.edit_list:
+                edits = [other for other in edits if not edit.overwrites(other)]
+                if not edit.is_noop():
+                    edits.append(edit)
+        # edits are applied file by file, see AbstractProgram.get_modified_contents
+        files = {}
+        for edit in edits:
+            files.setdefault(edit.target[0], []).append(edit)
+        edit_list = []
+        for target_file in sorted(files):
+            file_edits = files[target_file]
+            keys = [edit.sort_key() for edit in file_edits]
+            if None not in keys:
+                order = sorted(range(len(file_edits)), key=lambda i: keys[i])
+                file_edits = [file_edits[i] for i in order]
+            edit_list.extend(file_edits)
+        return Patch(edit_list)
+
     def add(self, edit):
         """
         Add an edit to the edit list
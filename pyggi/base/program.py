@@ -11,14 +11,34 @@ import subprocess
 import shlex
 import copy
 import difflib
-import select
+import selectors
 import signal
 import errno
+import fcntl
+import glob
+import hashlib
+import tempfile
 import logging
-from distutils.dir_util import copy_tree
+import queue
+import threading
+import resource
+import asyncio
+import concurrent.futures
+import sys
 
 from .. import config as pyggi_config
+from .patch import Patch
 from .runresult import RunResult
+from .capture import OutputCapture
+from .harness import Harness
+from . import limits
+
+class PipesizeExceeded(Exception):
+    """
+    Raised when a command outputs *max_pipesize* bytes
+    (see :py:meth:`AbstractProgram.async_exec_cmd`)
+    """
+    pass
 
 class AbstractProgram(ABC):
     """
@@ -29,17 +49,35 @@ class AbstractProgram(ABC):
     this class needs to process and store the source code accordingly
     (for example, by parsing and storing the AST).
     """
+    FICLONE = 0x40049409 # from linux/fs.h
+
     def __init__(self, path, config={}):
         self.path = os.path.abspath(path.strip())
         self.basename = os.path.basename(self.path)
         self.work_dir = None
         self.target_files = []
+        self.nb_workers = 1
+        self.timeout = 15
+        self.variant_check = False
+        self.copy_mode = 'copy'
+        self.harness_command = None
+        self.harnesses = {}
+        self.build_artifacts = {}
+        self.validate = False
+        self.cpu_affinity = None
+        self.rlimits = {}
+        self.tmp_variants = {}
+        self.dumps_memo = collections.OrderedDict()
+        self.dumps_memo_lock = threading.Lock()
+        self.dumps_memo_size = 16
+        self.current = None
         self.logger = None
         self.setup(config)
         self.reset()
 
     def reset(self):
         self.close_logger()
+        self.stop_harnesses()
         self.timestamp = str(int(time.time()))
 
         # ensures the timestamp is unique
@@ -74,10 +112,14 @@ class AbstractProgram(ABC):
             if pyggi_config.local_original_copy:
                 new_path = os.path.join(self.work_dir, pyggi_config.local_original_name)
                 if self.path != new_path:
-                    self.path = shutil.copytree(self.path, new_path)
+                    self.path = self.copy_tree(self.path, new_path)
         os.remove(lock_file)
 
         self.work_path = os.path.join(self.work_dir, self.basename)
+        self.tmp_variants = {}
+        self.work_paths = [self.work_path]
+        for i in range(1, self.nb_workers):
+            self.work_paths.append('{}_{}'.format(self.work_path, i))
         self.setup_logger()
         self.reset_tmp_variant()
         self.load_contents()
@@ -90,6 +132,15 @@ class AbstractProgram(ABC):
         for key in [
                 'test_command',
                 'target_files',
+                'nb_workers',
+                'timeout',
+                'variant_check',
+                'copy_mode',
+                'harness_command',
+                'build_artifacts',
+                'validate',
+                'cpu_affinity',
+                'rlimits',
         ]:
             try:
                 self.__dict__[key] = config[key]
@@ -136,12 +187,24 @@ class AbstractProgram(ABC):
 
     def load_contents(self):
         self.load_engines()
+        with self.dumps_memo_lock:
+            self.dumps_memo.clear()
+        self.original_dumps = None
+        self.current = None
         self.contents = {}
         self.locations = {}
         self.locations_weights = {}
+        # files are parsed by engine, so that they can be processed at once
+        contents = {}
+        files_by_engine = collections.OrderedDict()
+        for file_name in self.target_files:
+            files_by_engine.setdefault(self.engines[file_name], []).append(file_name)
+        for engine, file_names in files_by_engine.items():
+            paths = [os.path.join(self.path, file_name) for file_name in file_names]
+            contents.update(zip(file_names, engine.get_contents_batch(paths)))
         for file_name in self.target_files:
             engine = self.engines[file_name]
-            self.contents[file_name] = engine.get_contents(os.path.join(self.path, file_name))
+            self.contents[file_name] = contents[file_name]
             self.locations[file_name] = engine.get_locations(self.contents[file_name])
 
     def random_file(self, engine=None):
@@ -170,18 +233,111 @@ class AbstractProgram(ABC):
             pass
         return (target_file, target_type, random.randrange(len(self.locations[target_file][target_type])))
 
-    def reset_tmp_variant(self):
-        # TODO: be more like rsync
-        self.remove_tmp_variant()
-        shutil.copytree(self.path, self.work_path)
-
-    def remove_tmp_variant(self):
+    def reset_tmp_variant(self, work_path=None):
+        work_path = work_path or self.work_path
         try:
-            shutil.rmtree(self.work_path)
+            shutil.rmtree(work_path)
         except FileNotFoundError:
             pass
+        self.copy_tree(self.path, work_path)
+        # the variant directory is then kept alive between evaluations,
+        # only target files that differ from the last write being rewritten
+        self.tmp_variants[work_path] = {'dumps': {}, 'snapshot': None}
+
+    def copy_tree(self, src, dst):
+        """
+        Copy the program directory *src* into *dst* according to *copy_mode*:
+        - 'copy': regular copies
+        - 'reflink': copy-on-write clones (FICLONE) when supported, else copies
+        - 'link': copy-on-write clones when supported, else hard links
+        Target files are always freshly copied.
+        In 'link' mode, the test command must not modify files in place.
+
+        :return: The destination directory
+        :rtype: str
+        """
+        if self.copy_mode not in ['copy', 'reflink', 'link']:
+            raise ValueError('Unknown copy mode: {}'.format(self.copy_mode))
+        targets = {os.path.join(src, target_file) for target_file in self.target_files}
+        def copy_function(src_file, dst_file):
+            if self.copy_mode == 'copy' or src_file in targets:
+                return shutil.copy2(src_file, dst_file)
+            if self.reflink(src_file, dst_file):
+                return dst_file
+            if self.copy_mode == 'link':
+                try:
+                    os.link(src_file, dst_file)
+                    return dst_file
+                except OSError:
+                    pass
+            return shutil.copy2(src_file, dst_file)
+        return shutil.copytree(src, dst, copy_function=copy_function)
+
+    def reflink(self, src_file, dst_file):
+        if getattr(self, '_reflink_unsupported', False):
+            return False
+        try:
+            with open(src_file, 'rb') as fsrc, open(dst_file, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), self.FICLONE, fsrc.fileno())
+            shutil.copystat(src_file, dst_file)
+            return True
+        except OSError as e:
+            if e.errno in [errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS]:
+                self._reflink_unsupported = True
+            try:
+                os.remove(dst_file)
+            except FileNotFoundError:
+                pass
+            return False
+
+    def remove_tmp_variant(self):
+        self.stop_harnesses()
+        for work_path in self.work_paths:
+            self.tmp_variants.pop(work_path, None)
+            try:
+                shutil.rmtree(work_path)
+            except FileNotFoundError:
+                pass
+
+    def snapshot_tmp_variant(self, work_path=None):
+        work_path = work_path or self.work_path
+        snapshot = {}
+        for root, _, files in os.walk(work_path):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                try:
+                    stat = os.lstat(path)
+                except FileNotFoundError:
+                    continue
+                snapshot[path] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def check_tmp_variant(self, work_path=None):
+        """
+        Check that running the test command did not modify or delete
+        any file of the variant directory (new files are allowed).
+        Modified variant directories are fully copied again before the next evaluation.
+
+        :return: Whether the variant directory is still clean
+        :rtype: bool
+        """
+        work_path = work_path or self.work_path
+        try:
+            before = self.tmp_variants[work_path]['snapshot']
+        except KeyError:
+            return False
+        if before is None:
+            return True
+        after = self.snapshot_tmp_variant(work_path)
+        for path in before:
+            if after.get(path) != before[path]:
+                self.logger.debug('Variant modified by test command: {}'.format(path))
+                del self.tmp_variants[work_path]
+                return False
+        return True
 
     def clean_work_dir(self):
+        self.stop_harnesses()
         if self.work_dir:
             try:
                 shutil.rmtree(self.work_dir)
@@ -195,19 +351,31 @@ class AbstractProgram(ABC):
             if e.errno != errno.ENOTEMPTY:
                 raise
 
-    def write_to_tmp_dir(self, new_contents):
+    def write_to_tmp_dir(self, new_contents, work_path=None):
         """
         Write new contents to the temporary directory of program
 
         :param new_contents: The new contents of the program.
           Refer to *apply* method of :py:class:`.patch.Patch`
         :type new_contents: dict(str, ?)
+        :param work_path: The variant directory to write to (default: *work_path*)
+        :type work_path: str
         :rtype: None
         """
-        for target_file in new_contents:
-            engine = self.engines[target_file]
-            tmp_path = os.path.join(self.work_path, target_file)
-            engine.write_to_tmp_dir(new_contents[target_file], tmp_path)
+        self.write_dumps_to_tmp_dir(self.dump_contents(new_contents), work_path)
+
+    def write_dumps_to_tmp_dir(self, new_dumps, work_path=None):
+        work_path = work_path or self.work_path
+        try:
+            dumps = self.tmp_variants[work_path]['dumps']
+        except KeyError:
+            dumps = {}
+        for target_file, dump in new_dumps.items():
+            if dumps.get(target_file) == dump:
+                continue
+            tmp_path = os.path.join(work_path, target_file)
+            self.engines[target_file].write_dump_to_tmp_dir(dump, tmp_path)
+            dumps[target_file] = dump
 
     def dump(self, contents, file_name):
         """
@@ -219,20 +387,191 @@ class AbstractProgram(ABC):
         """
         return self.engines[file_name].dump(contents[file_name])
 
+    def dump_contents(self, contents):
+        return {target_file: self.dump(contents, target_file) for target_file in contents}
+
+    def get_modified_dumps(self, patch):
+        """
+        Dump the patch-applied program.
+        The last *dumps_memo_size* results are memoized (by patch),
+        so that the cache key, the evaluation, and the diff of a same patch
+        only apply it once.
+
+        :return: The source code of each target file
+        :rtype: dict(str, str)
+        """
+        key = str(patch)
+        with self.dumps_memo_lock:
+            try:
+                self.dumps_memo.move_to_end(key)
+                return self.dumps_memo[key]
+            except KeyError:
+                pass
+        dumps = self.get_incremental_dumps(patch)
+        if dumps is None:
+            # the files the patch does not touch are shared with the original
+            new_contents = self.get_modified_contents(patch)
+            dumps = dict(self.get_original_dumps())
+            for target_file in self.get_touched_files(patch):
+                dumps[target_file] = self.dump(new_contents, target_file)
+        with self.dumps_memo_lock:
+            self.dumps_memo[key] = dumps
+            while len(self.dumps_memo) > self.dumps_memo_size:
+                self.dumps_memo.popitem(last=False)
+        return dumps
+
+    def get_original_dumps(self):
+        """
+        :return: The source code of each target file of the original program
+        :rtype: dict(str, str)
+        """
+        if self.original_dumps is None:
+            self.original_dumps = self.dump_contents(self.contents)
+        return self.original_dumps
+
+    def variant_key(self, patch):
+        """
+        :return: A hash of the source code of the patch-applied program,
+          identical for patches leading to the same variant
+        :rtype: str
+        """
+        return self.dumps_key(self.get_modified_dumps(patch))
+
+    def cache_namespace(self):
+        """
+        :return: A hash of what run results depend on besides the variant
+          source code (test command, instances, ...), see :py:class:`.SqliteCache`
+        :rtype: str
+        """
+        data = [
+            self.__class__.__qualname__,
+            self.basename,
+            self.test_command,
+            self.harness_command,
+            repr(getattr(self, 'instances', None)),
+        ]
+        return hashlib.sha1(json.dumps(data).encode()).hexdigest()
+
+    def dumps_key(self, dumps):
+        h = hashlib.sha1()
+        for target_file in sorted(dumps):
+            h.update(target_file.encode())
+            h.update(b'\0')
+            h.update(dumps[target_file].encode())
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def validate_dumps(self, dumps):
+        """
+        Check each dumped file with the *validate_dump* hook of its engine
+        (e.g., :py:class:`.AstorEngine` compiles it), without writing anything.
+
+        :return: Whether all the files are valid
+        :rtype: bool
+        """
+        for target_file, dump in dumps.items():
+            if not self.engines[target_file].validate_dump(dump, target_file):
+                self.logger.debug('Invalid variant: {}'.format(target_file))
+                return False
+        return True
+
     def get_modified_contents(self, patch):
-        new_locations = copy.deepcopy(self.locations)
-        new_contents = copy.deepcopy(self.contents)
+        new_contents, _ = self.get_modified_state(patch)
+        return new_contents
+
+    def get_modified_state(self, patch):
+        """
+        Apply *patch* to copies of the files it touches (see *touched_files*
+        of :py:class:`.base.AbstractEdit`); the other files are shared with
+        the original program and must not be modified.
+
+        :return: The contents and the locations of the patch-applied program
+        :rtype: tuple(dict, dict)
+        """
+        touched = self.get_touched_files(patch)
+        new_contents = dict(self.contents)
+        new_locations = dict(self.locations)
+        for target_file in touched:
+            new_contents[target_file] = copy.deepcopy(self.contents[target_file])
+            new_locations[target_file] = copy.deepcopy(self.locations[target_file])
         for target_file in self.contents.keys():
             edits = list(filter(lambda a: a.target[0] == target_file, patch.edit_list))
             for edit in edits:
                 edit.apply(self, new_contents, new_locations)
-        return new_contents
+        return new_contents, new_locations
+
+    def get_touched_files(self, patch):
+        """
+        :return: The target files that *patch* may modify
+        :rtype: set(str)
+        """
+        touched = set()
+        for edit in patch.edit_list:
+            if edit.target[0] in self.contents:
+                touched.update(edit.touched_files())
+        return touched
 
-    def apply(self, patch):
+    def set_current(self, patch):
+        """
+        Materialize *patch* as the current solution (e.g., of a local search):
+        the variants of patches extending it with a few edits are then built by
+        applying only these edits, see :py:meth:`get_incremental_dumps`.
+
+        :param patch: The current patch, or None to forget it
+        :type patch: :py:class:`.Patch`
+        """
+        if patch is None:
+            self.current = None
+            return
+        edits = list(patch.edit_list)
+        if not all(edit.touched_files() == {edit.target[0]} for edit in edits):
+            self.current = None
+            return
+        contents, locations = self.get_modified_state(patch)
+        dumps = self.dump_contents(contents)
+        self.current = (edits, contents, locations, dumps)
+
+    def get_incremental_dumps(self, patch):
+        """
+        Dump the patch-applied program from the current solution (see
+        :py:meth:`set_current`) when *patch* extends it, copying and editing
+        only the files touched by the extra edits. The current solution itself
+        is never modified, so that rejected neighbours need not be undone.
+
+        :return: The source code of each target file, or None if *patch*
+          does not extend the current solution
+        :rtype: dict(str, str)
+        """
+        current = self.current
+        if current is None:
+            return None
+        edits, contents, locations, dumps = current
+        if patch.edit_list[:len(edits)] != edits:
+            return None
+        delta = patch.edit_list[len(edits):]
+        for edit in delta:
+            if edit.target[0] not in self.contents or edit.touched_files() != {edit.target[0]}:
+                return None
+        # edits are applied file by file: the delta of each file comes last
+        touched = {edit.target[0] for edit in delta}
+        new_contents = dict(contents)
+        new_locations = dict(locations)
+        for target_file in touched:
+            new_contents[target_file] = copy.deepcopy(contents[target_file])
+            new_locations[target_file] = copy.deepcopy(locations[target_file])
+        for edit in delta:
+            edit.apply(self, new_contents, new_locations)
+        new_dumps = dict(dumps)
+        for target_file in touched:
+            new_dumps[target_file] = self.dump(new_contents, target_file)
+        return new_dumps
+
+    def apply(self, patch, work_path=None):
         """
         This method applies the patch to the target program.
         It does not directly modify the source code of the original program,
-        but modifies the copied program within the temporary directory.
+        but modifies the copied program within the temporary directory
+        (or within *work_path* if given, see :py:meth:`evaluate_patches`).
 
         :return: The contents of the patch-applied program, See *Hint*.
         :rtype: dict(str, list(str))
@@ -241,53 +580,249 @@ class AbstractProgram(ABC):
             - key: The target file name(path) related to the program root path
             - value: The contents of the file
         """
-        self.reset_tmp_variant()
         new_contents = self.get_modified_contents(patch)
-        self.write_to_tmp_dir(new_contents)
+        self.prepare_tmp_variant(self.dump_contents(new_contents), work_path)
         return new_contents
 
-    def exec_cmd(self, cmd, timeout=15, env=None, shell=False, max_pipesize=1e4):
+    def prepare_tmp_variant(self, dumps, work_path=None):
+        work_path = work_path or self.work_path
+        if work_path not in self.tmp_variants:
+            self.reset_tmp_variant(work_path)
+        self.write_dumps_to_tmp_dir(dumps, work_path)
+        if self.build_artifacts:
+            self.restore_artifacts(work_path)
+        if self.variant_check:
+            self.tmp_variants[work_path]['snapshot'] = self.snapshot_tmp_variant(work_path)
+
+    def artifact_key(self, target_file, dump):
+        return hashlib.sha1('{}\0{}'.format(target_file, dump).encode()).hexdigest()
+
+    def glob_artifacts(self, work_path, target_file):
+        paths = set()
+        for pattern in self.build_artifacts[target_file]:
+            paths.update(glob.glob(os.path.join(glob.escape(work_path), pattern)))
+        return sorted(path for path in paths if os.path.isfile(path))
+
+    def restore_artifacts(self, work_path=None):
+        """
+        Restore the build artifacts of each target file of *build_artifacts*.
+
+        *build_artifacts* maps target files to glob patterns (relative to
+        the program root) of the files built from them, e.g.,
+        ``{'Triangle.java': ['Triangle*.class']}``. Artifacts are cached
+        by content of the written target file: stale artifacts are removed,
+        then cached ones are copied back, so that the build step only has to
+        rebuild missing artifacts (e.g., ``[ -f Triangle.class ] || javac ...``).
+        Missing artifacts are cached after the test command, provided it
+        exited cleanly (i.e., with return code 0, not killed).
+        """
+        work_path = work_path or self.work_path
+        variant = self.tmp_variants[work_path]
+        present = variant.setdefault('artifacts', {})
+        variant['artifact_misses'] = []
+        for target_file in self.build_artifacts:
+            key = self.artifact_key(target_file, variant['dumps'].get(target_file))
+            if present.get(target_file) == key:
+                continue
+            for path in self.glob_artifacts(work_path, target_file):
+                os.remove(path)
+            present.pop(target_file, None)
+            cache_path = os.path.join(self.work_dir, '__build_cache__', key)
+            if os.path.isdir(cache_path):
+                for root, _, files in os.walk(cache_path):
+                    for file_name in files:
+                        path = os.path.join(root, file_name)
+                        dst_path = os.path.join(work_path, os.path.relpath(path, cache_path))
+                        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+                        shutil.copy(path, dst_path)
+                present[target_file] = key
+            else:
+                variant['artifact_misses'].append((target_file, key))
+
+    def store_artifacts(self, work_path=None):
+        work_path = work_path or self.work_path
+        variant = self.tmp_variants[work_path]
+        cache_dir = os.path.join(self.work_dir, '__build_cache__')
+        os.makedirs(cache_dir, exist_ok=True)
+        for target_file, key in variant.pop('artifact_misses', []):
+            paths = self.glob_artifacts(work_path, target_file)
+            if not paths:
+                continue
+            tmp_path = tempfile.mkdtemp(dir=cache_dir)
+            for path in paths:
+                dst_path = os.path.join(tmp_path, os.path.relpath(path, work_path))
+                os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+                shutil.copy(path, dst_path)
+            try:
+                os.rename(tmp_path, os.path.join(cache_dir, key))
+            except OSError: # concurrently cached by another worker
+                shutil.rmtree(tmp_path)
+            variant['artifacts'][target_file] = key
+
+    def finalize_tmp_variant(self, work_path, return_code):
+        if self.variant_check and not self.check_tmp_variant(work_path):
+            return
+        if self.build_artifacts and return_code == 0:
+            self.store_artifacts(work_path)
+
+    def exec_cmd(self, cmd, timeout=15, env=None, shell=False, max_pipesize=1e4, cwd=None, buffer_size=1e6, spill_path=None, rusage=False):
+        """
+        Run *cmd* in a new process group, capturing its outputs.
+
+        Outputs are read by chunks as soon as they are available;
+        the child is killed as soon as it exceeds *timeout* seconds
+        or produces *max_pipesize* bytes (unless None), no more than
+        *max_pipesize* bytes being read in total.
+        Only the last *buffer_size* bytes of each stream are kept,
+        the whole streams being written to *spill_path*.stdout and
+        *spill_path*.stderr if given.
+        The child is reaped with *os.wait4*: if *rusage* is True, its resource
+        usage (see :py:meth:`rusage_to_dict`) is returned as fifth element.
+
+        :return: The return code (None on timeout), stdout, stderr, and elapsed time
+        :rtype: tuple(int, bytes, bytes, float)
+        """
         # 1e6 bytes is 1Mb
+        if buffer_size is not None:
+            buffer_size = int(buffer_size)
+        stdout = OutputCapture(buffer_size, spill_path and '{}.stdout'.format(spill_path))
+        stderr = OutputCapture(buffer_size, spill_path and '{}.stderr'.format(spill_path))
+        selector = selectors.DefaultSelector()
         sprocess = None
+        pidfd = None
+        usage = None
+        if max_pipesize is not None:
+            max_pipesize = int(max_pipesize)
         try:
-            stdout = b''
-            stderr = b''
-            stdout_size = 0
-            stderr_size = 0
             start = time.time()
-            sprocess = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=os.setsid, env=env, shell=shell)
-            while sprocess.poll() is None:
-                end = time.time()
-                if end-start > timeout:
-                    raise TimeoutError()
-                a = select.select([sprocess.stdout, sprocess.stderr], [], [], 1)[0]
-                if sprocess.stdout in a:
-                    for _ in range(1024):
-                        if not len(select.select([sprocess.stdout], [], [], 0)[0]):
-                            break
-                        stdout += sprocess.stdout.read(1)
-                        stdout_size += 1
-                if sprocess.stderr in a:
-                    for _ in range(1024):
-                        if not len(select.select([sprocess.stderr], [], [], 0)[0]):
-                            break
-                        stderr += sprocess.stderr.read(1)
-                        stderr_size += 1
-                if stdout_size+stderr_size >= max_pipesize:
-                    raise IOError()
+            deadline = start + timeout
+            sprocess = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True, env=env, shell=shell, cwd=cwd)
+            # not reaped yet, so this is still the child's group (and its pid)
+            pgid = os.getpgid(sprocess.pid)
+            selector.register(sprocess.stdout.fileno(), selectors.EVENT_READ, stdout)
+            selector.register(sprocess.stderr.fileno(), selectors.EVENT_READ, stderr)
+            try:
+                # wakes up as soon as the child exits (Linux >= 5.3)
+                pidfd = os.pidfd_open(sprocess.pid)
+                selector.register(pidfd, selectors.EVENT_READ, None)
+            except (AttributeError, OSError):
+                pass
+            killed = False
+            while len(selector.get_map()) > (pidfd is not None):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    killed = 'timeout'
+                    break
+                if pidfd is None:
+                    remaining = min(remaining, 0.05)
+                for key, _ in selector.select(remaining):
+                    if key.data is None:
+                        selector.unregister(pidfd)
+                        os.close(pidfd)
+                        pidfd = None
+                        continue
+                    data = os.read(key.fd, self._read_size(max_pipesize, stdout, stderr))
+                    if data:
+                        key.data.write(data)
+                    else:
+                        selector.unregister(key.fd)
+                    if max_pipesize is not None and stdout.total+stderr.total >= max_pipesize:
+                        killed = 'pipesize'
+                        break
+                if killed:
+                    break
+                if pidfd is None:
+                    usage = self._reap(sprocess, False)
+                    if usage is not None:
+                        # drain what is left without waiting for grandchildren
+                        self._drain_selector(selector, max_pipesize, stdout, stderr)
+                        break
+            if not killed and usage is None:
+                delay = 0.0005
+                while True:
+                    usage = self._reap(sprocess, False)
+                    if usage is not None:
+                        break
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        killed = 'timeout'
+                        break
+                    delay = min(delay * 2, remaining, 0.05)
+                    time.sleep(delay)
             end = time.time()
-            stdout += sprocess.stdout.read()
-            stderr += sprocess.stderr.read()
-            return (sprocess.returncode, stdout, stderr, end-start)
+            if killed:
+                try:
+                    os.killpg(pgid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                if usage is None:
+                    usage = self._reap(sprocess, True)
+            return_code = None if killed == 'timeout' else sprocess.returncode
+            if rusage:
+                return (return_code, stdout.getvalue(), stderr.getvalue(), end-start, self.rusage_to_dict(usage))
+            return (return_code, stdout.getvalue(), stderr.getvalue(), end-start)
 
-        except (TimeoutError, IOError):
-            end = time.time()
+        finally:
+            selector.close()
+            if pidfd is not None:
+                os.close(pidfd)
             if sprocess:
-                os.killpg(os.getpgid(sprocess.pid), signal.SIGKILL)
-                _, _ = sprocess.communicate()
-                return (sprocess.returncode, stdout, stderr, end-start)
-            else:
-                raise
+                sprocess.stdout.close()
+                sprocess.stderr.close()
+            stdout.close()
+            stderr.close()
+
+    @staticmethod
+    def _reap(sprocess, block):
+        # os.wait4 instead of Popen.wait, to get the resource usage of the child
+        pid, status, usage = os.wait4(sprocess.pid, 0 if block else os.WNOHANG)
+        if pid == 0:
+            return None
+        if os.WIFSIGNALED(status):
+            sprocess.returncode = -os.WTERMSIG(status)
+        else:
+            sprocess.returncode = os.WEXITSTATUS(status)
+        return usage
+
+    @staticmethod
+    def rusage_to_dict(usage):
+        """
+        :return: The user, system and total CPU times (in seconds), the peak
+          resident set size (in kilobytes on Linux), and the numbers of
+          voluntary and involuntary context switches
+        :rtype: dict(str, float)
+        """
+        return {
+            'user_time': usage.ru_utime,
+            'system_time': usage.ru_stime,
+            'cpu_time': usage.ru_utime + usage.ru_stime,
+            'max_rss': usage.ru_maxrss,
+            'voluntary_switches': usage.ru_nvcsw,
+            'involuntary_switches': usage.ru_nivcsw,
+        }
+
+    @staticmethod
+    def _read_size(max_pipesize, stdout, stderr):
+        # never read past max_pipesize, so that the limit holds exactly
+        if max_pipesize is None:
+            return 1 << 16
+        return max(min(1 << 16, max_pipesize - stdout.total - stderr.total), 0)
+
+    @classmethod
+    def _drain_selector(cls, selector, max_pipesize, stdout, stderr):
+        while len(selector.get_map()) > 0:
+            events = selector.select(0)
+            if not events:
+                break
+            for key, _ in events:
+                size = cls._read_size(max_pipesize, stdout, stderr)
+                if size == 0:
+                    return
+                data = os.read(key.fd, size) if key.data is not None else None
+                if data:
+                    key.data.write(data)
+                else:
+                    selector.unregister(key.fd)
 
     def compute_fitness(self, result, return_code, stdout, stderr, elapsed_time):
         try:
@@ -295,21 +830,249 @@ class AbstractProgram(ABC):
         except:
             result.status = 'PARSE_ERROR'
 
-    def evaluate_patch(self, patch, timeout=15):
+    def evaluate_patch(self, patch, timeout=None, work_path=None):
         # apply + run
-        self.apply(patch)
-        cwd = os.getcwd()
+        work_path = work_path or self.work_path
+        timeout = timeout or self.timeout
+        dumps = self.get_modified_dumps(patch)
+        if self.validate and not self.validate_dumps(dumps):
+            return RunResult('INVALID')
+        self.prepare_tmp_variant(dumps, work_path)
+        return_code, stdout, stderr, elapsed_time, rusage = self.run_test(work_path, timeout)
+        self.finalize_tmp_variant(work_path, return_code)
+        return self.process_run(return_code, stdout, stderr, elapsed_time, rusage)
+
+    def run_test(self, work_path=None, timeout=None):
+        """
+        Run the test command within *work_path*, or send the variant
+        to the persistent evaluator if *harness_command* is set
+        (see :py:class:`.Harness` for the protocol).
+
+        :return: The return code (None on timeout), stdout, stderr, elapsed time,
+          and resource usage (None if unknown)
+        :rtype: tuple(int, bytes, bytes, float, dict(str, float))
+        """
+        work_path = work_path or self.work_path
+        timeout = timeout or self.timeout
+        if self.harness_command:
+            return self.get_harness(work_path).evaluate(work_path, timeout) + (None,)
+        return self.exec_cmd(self.limit_command(shlex.split(self.test_command), work_path), timeout, cwd=work_path, rusage=True)
+
+    def get_cpu_set(self, work_path=None):
+        """
+        *cpu_affinity* is either None (no pinning), 'auto' (the available cores
+        are evenly split between the variant directories), or a list of core
+        sets, the i-th one being used for the i-th variant directory.
+
+        :return: The cores the evaluations within *work_path* are pinned to
+        :rtype: set(int) or None
+        """
+        work_path = work_path or self.work_path
+        index = self.work_paths.index(work_path)
+        if self.cpu_affinity is None:
+            return None
+        elif self.cpu_affinity == 'auto':
+            cores = sorted(os.sched_getaffinity(0))
+            n = len(self.work_paths)
+            if len(cores) < n:
+                return {cores[index % len(cores)]}
+            return set(cores[index*len(cores)//n:(index+1)*len(cores)//n])
+        else:
+            return set(self.cpu_affinity[index % len(self.cpu_affinity)])
+
+    def get_rlimits(self, harness=False):
+        """
+        *rlimits* maps resource names to either a limit or a pair (soft, hard),
+        e.g., ``{'as': 2**31, 'cpu': 60, 'nofile': 256, 'fsize': 2**26}``
+        (see *resource.RLIMIT_AS*, etc.).
+        The limits of a persistent evaluator (if *harness* is True) hold for
+        its whole lifetime, so 'cpu' is ignored there: CPU time would add up
+        across evaluations, each one being bounded by *timeout* instead.
+
+        :return: The pairs (resource, (soft, hard)) to apply
+        :rtype: list(tuple(int, tuple(int, int)))
+        """
+        limits = []
+        for name, value in self.rlimits.items():
+            if harness and name.lower() == 'cpu':
+                continue
+            if not isinstance(value, (tuple, list)):
+                value = (value, value)
+            limits.append((getattr(resource, 'RLIMIT_{}'.format(name.upper())), tuple(value)))
+        return limits
+
+    def limit_command(self, cmd, work_path=None, harness=False):
+        """
+        Wrap *cmd* so that it is pinned to the cores of *work_path*
+        (see :py:meth:`get_cpu_set`) and runs under *rlimits*
+        (see :py:meth:`get_rlimits`). Both are set by an exec wrapper
+        (see :py:mod:`pyggi.base.limits`) in the child itself, so that the
+        processes it starts (e.g., a build step) inherit them; a *preexec_fn*
+        is not safe when evaluations run in several threads.
+
+        :return: The command to run (*cmd* itself if there is nothing to apply)
+        :rtype: list(str)
+        """
+        cpu_set = self.get_cpu_set(work_path)
+        rlimits = self.get_rlimits(harness)
+        if cpu_set is None and not rlimits:
+            return cmd
+        settings = json.dumps([sorted(cpu_set) if cpu_set is not None else None, rlimits])
+        return [sys.executable, '-S', limits.__file__, settings] + list(cmd)
+
+    def get_harness(self, work_path=None):
+        work_path = work_path or self.work_path
         try:
-            os.chdir(self.work_path)
-            return_code, stdout, stderr, elapsed_time = self.exec_cmd(shlex.split(self.test_command), timeout)
-        finally:
-            os.chdir(cwd)
+            return self.harnesses[work_path]
+        except KeyError:
+            log_path = os.path.join(self.work_dir, '{}.harness.log'.format(os.path.basename(work_path)))
+            harness = Harness(self.limit_command(shlex.split(self.harness_command), work_path, harness=True), cwd=work_path, log_path=log_path)
+            self.harnesses[work_path] = harness
+            return harness
+
+    def stop_harnesses(self):
+        for harness in self.harnesses.values():
+            harness.stop()
+        self.harnesses = {}
+
+    def process_run(self, return_code, stdout, stderr, elapsed_time, rusage=None):
         if return_code is None: # timeout
-            return RunResult('TIMEOUT')
+            result = RunResult('TIMEOUT')
         else:
             result = RunResult('SUCCESS', None)
+            # e.g., result.cpu_time or result.max_rss, usable in compute_fitness
+            for key, value in (rusage or {}).items():
+                setattr(result, key, value)
             self.compute_fitness(result, return_code, stdout.decode("ascii"), stderr.decode("ascii"), elapsed_time)
-            return result
+        result.elapsed_time = elapsed_time
+        return result
+
+    def evaluate_patches(self, patches, timeout=None):
+        """
+        Evaluate several patches concurrently, each worker running
+        in its own copy of the program (see *nb_workers*).
+
+        :param patches: The patches to evaluate
+        :type patches: iterable(:py:class:`.Patch`)
+        :return: The pairs (patch, run result), in order of completion
+        :rtype: iterator(tuple(:py:class:`.Patch`, :py:class:`.RunResult`))
+        """
+        if len(self.work_paths) == 1:
+            for patch in patches:
+                yield (patch, self.evaluate_patch(patch, timeout))
+            return
+        sandboxes = queue.Queue()
+        for work_path in self.work_paths:
+            sandboxes.put(work_path)
+        def work(patch):
+            work_path = sandboxes.get()
+            try:
+                return (patch, self.evaluate_patch(patch, timeout, work_path))
+            finally:
+                sandboxes.put(work_path)
+        with concurrent.futures.ThreadPoolExecutor(len(self.work_paths)) as executor:
+            futures = [executor.submit(work, patch) for patch in patches]
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    yield future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    async def async_exec_cmd(self, cmd, timeout=15, env=None, max_pipesize=1e4, cwd=None, buffer_size=1e6):
+        """
+        Coroutine version of :py:meth:`exec_cmd`, based on asyncio.
+
+        :return: The return code (None on timeout), stdout, stderr, and elapsed time
+        :rtype: tuple(int, bytes, bytes, float)
+        """
+        if buffer_size is not None:
+            buffer_size = int(buffer_size)
+        if max_pipesize is not None:
+            max_pipesize = int(max_pipesize)
+        stdout = OutputCapture(buffer_size)
+        stderr = OutputCapture(buffer_size)
+        async def pump(stream, capture):
+            while True:
+                data = await stream.read(self._read_size(max_pipesize, stdout, stderr))
+                if not data:
+                    return
+                capture.write(data)
+                if max_pipesize is not None and stdout.total+stderr.total >= max_pipesize:
+                    raise PipesizeExceeded()
+        async def discard(stream):
+            while await stream.read(1 << 16):
+                pass
+        start = time.time()
+        sprocess = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, start_new_session=True, env=env, cwd=cwd)
+        try:
+            pgid = os.getpgid(sprocess.pid)
+        except ProcessLookupError: # already exited and reaped by the child watcher
+            pgid = sprocess.pid # session leader: its pid is the group id
+        killed = False
+        tasks = [asyncio.ensure_future(pump(sprocess.stdout, stdout)),
+                 asyncio.ensure_future(pump(sprocess.stderr, stderr)),
+                 asyncio.ensure_future(sprocess.wait())]
+        try:
+            await asyncio.wait_for(asyncio.gather(*tasks), timeout)
+        except asyncio.TimeoutError:
+            killed = 'timeout'
+        except PipesizeExceeded:
+            killed = 'pipesize'
+        finally:
+            # gather does not cancel the other tasks when one of them fails
+            for task in tasks:
+                task.cancel()
+        end = time.time()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if killed:
+            try:
+                os.killpg(pgid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            # the process is only waited for once its pipes are read to the end
+            try:
+                await asyncio.wait_for(asyncio.gather(discard(sprocess.stdout),
+                                                      discard(sprocess.stderr),
+                                                      sprocess.wait()), 1)
+            except asyncio.TimeoutError: # e.g., held open by a daemon out of the group
+                pass
+        return_code = None if killed == 'timeout' else sprocess.returncode
+        return (return_code, stdout.getvalue(), stderr.getvalue(), end-start)
+
+    async def async_evaluate_patch(self, patch, timeout=None):
+        """
+        Coroutine version of :py:meth:`evaluate_patch`.
+        At most *nb_workers* variants are evaluated at the same time,
+        each one in its own copy of the program.
+        The resource usage of the test command is not reported.
+
+        :return: The result of the evaluation
+        :rtype: :py:class:`.RunResult`
+        """
+        timeout = timeout or self.timeout
+        loop = asyncio.get_event_loop()
+        if getattr(self, '_async_loop', None) is not loop:
+            self._async_loop = loop
+            self._async_slots = asyncio.Semaphore(len(self.work_paths))
+            self._async_sandboxes = list(self.work_paths)
+        dumps = await loop.run_in_executor(None, self.get_modified_dumps, patch)
+        if self.validate and not self.validate_dumps(dumps):
+            return RunResult('INVALID')
+        async with self._async_slots:
+            work_path = self._async_sandboxes.pop()
+            try:
+                await loop.run_in_executor(None, self.prepare_tmp_variant, dumps, work_path)
+                if self.harness_command:
+                    harness = self.get_harness(work_path)
+                    run = loop.run_in_executor(None, harness.evaluate, work_path, timeout)
+                else:
+                    run = self.async_exec_cmd(self.limit_command(shlex.split(self.test_command), work_path), timeout, cwd=work_path)
+                return_code, stdout, stderr, elapsed_time = await run
+                self.finalize_tmp_variant(work_path, return_code)
+            finally:
+                self._async_sandboxes.append(work_path)
+        return self.process_run(return_code, stdout, stderr, elapsed_time)
 
     def diff(self, patch) -> str:
         """
@@ -320,10 +1083,11 @@ class AbstractProgram(ABC):
         :rtype: str
         """
         diffs = ''
-        new_contents = self.get_modified_contents(patch)
+        orig_dumps = self.get_modified_dumps(Patch())
+        new_dumps = self.get_modified_dumps(patch)
         for file_name in self.target_files:
-            orig = self.dump(self.contents, file_name)
-            modi = self.dump(new_contents, file_name)
+            orig = orig_dumps[file_name]
+            modi = new_dumps[file_name]
             orig_list = list(map(lambda s: s+'\n', orig.splitlines()))
             modi_list = list(map(lambda s: s+'\n', modi.splitlines()))
             for diff in difflib.context_diff(orig_list, modi_list,
@@ -1,4 +1,5 @@
 from .abstract_engine import AbstractLineEngine
+from .buffer import LineBuffer, LineOffsets
 from .engine import LineEngine
 from .program import LineProgram
 from .edits import LineReplacement, LineInsertion, LineDeletion, LineMoving
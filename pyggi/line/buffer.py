@@ -0,0 +1,163 @@
+import bisect
+
+class LineBuffer:
+    """
+    LineBuffer is a list-like sequence of lines stored as a piece table.
+    The original lines are shared read-only by all the copies of a buffer,
+    and each replaced or inserted line is appended to an add buffer;
+    the buffer itself is a list of pieces, i.e., ranges of one of these.
+
+    Lookups use a bisection over the piece offsets and edits only split
+    and insert pieces, so their cost depends on the number of edits rather
+    than on the number of lines. Deep copies only copy the list of pieces.
+    """
+    def __init__(self, lines=()):
+        self.original = tuple(lines)
+        self.added = []
+        self.pieces = [] # (source, start, length)
+        self.starts = [] # offset of each piece
+        self.length = len(self.original)
+        if self.original:
+            self.pieces.append((self.original, 0, self.length))
+            self.starts.append(0)
+
+    def __deepcopy__(self, memo):
+        other = self.__class__.__new__(self.__class__)
+        other.original = self.original
+        other.added = [] # the other add buffers are append-only
+        other.pieces = list(self.pieces)
+        other.starts = list(self.starts)
+        other.length = self.length
+        return other
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for source, start, length in self.pieces:
+            yield from source[start:start+length]
+
+    def __eq__(self, other):
+        if not isinstance(other, (LineBuffer, list, tuple)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, repr(list(self)))
+
+    def index(self, i):
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError('{} index out of range'.format(self.__class__.__name__))
+        return i
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(self)[i]
+        i = self.index(i)
+        k = bisect.bisect_right(self.starts, i) - 1
+        source, start, _ = self.pieces[k]
+        return source[start + i - self.starts[k]]
+
+    def __setitem__(self, i, line):
+        i = self.index(i)
+        k = self.split(i)
+        self.split(i+1)
+        self.pieces[k] = self.add(line)
+
+    def insert(self, i, line):
+        if i < 0:
+            i = max(i + self.length, 0)
+        i = min(i, self.length)
+        k = self.split(i)
+        self.pieces.insert(k, self.add(line))
+        self.starts.insert(k, i)
+        for j in range(k+1, len(self.starts)):
+            self.starts[j] += 1
+        self.length += 1
+
+    def add(self, line):
+        self.added.append(line)
+        return (self.added, len(self.added)-1, 1)
+
+    def split(self, i):
+        """
+        Ensure that a piece starts at offset *i*
+
+        :return: The index of that piece (the number of pieces if *i* is the length)
+        :rtype: int
+        """
+        k = bisect.bisect_right(self.starts, i) - 1
+        if k < 0:
+            return 0
+        source, start, length = self.pieces[k]
+        offset = i - self.starts[k]
+        if offset == 0:
+            return k
+        if offset >= length:
+            return k+1
+        self.pieces[k:k+1] = [(source, start, offset), (source, start+offset, length-offset)]
+        self.starts.insert(k+1, i)
+        return k+1
+
+
+class LineOffsets:
+    """
+    LineOffsets maps the *length* original indices of a file to their current
+    positions, i.e., the identity shifted by the lines inserted before them.
+
+    Only the indices where shifts start are stored (sorted, with the
+    cumulative shifts), so that lookups are bisections and copies do not
+    depend on the number of lines.
+    """
+    def __init__(self, length):
+        self.length = length
+        self.points = []
+        self.shifts = [] # cumulative shift from each point
+
+    def __deepcopy__(self, memo):
+        other = self.__class__.__new__(self.__class__)
+        other.length = self.length
+        other.points = list(self.points)
+        other.shifts = list(self.shifts)
+        return other
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return (self[i] for i in range(self.length))
+
+    def __eq__(self, other):
+        if isinstance(other, LineOffsets):
+            return (self.length, self.points, self.shifts) == (other.length, other.points, other.shifts)
+        if isinstance(other, (list, tuple, range)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, repr(list(self)))
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError('{} index out of range'.format(self.__class__.__name__))
+        k = bisect.bisect_right(self.points, i)
+        return i + (self.shifts[k-1] if k > 0 else 0)
+
+    def shift(self, start, delta=1):
+        """
+        Shift the positions of the indices from *start* by *delta*
+        """
+        k = bisect.bisect_left(self.points, start)
+        if k == len(self.points) or self.points[k] != start:
+            self.points.insert(k, start)
+            self.shifts.insert(k, self.shifts[k-1] if k > 0 else 0)
+        for j in range(k, len(self.shifts)):
+            self.shifts[j] += delta
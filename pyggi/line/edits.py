@@ -4,6 +4,16 @@ from . import AbstractLineEngine
 
 
 class LineReplacement(AbstractEdit):
+    def overwrites(self, other):
+        return isinstance(other, (LineReplacement, LineDeletion)) and other.target == self.target
+
+    def is_noop(self):
+        # restores the original line
+        return self.target == self.data[0]
+
+    def sort_key(self):
+        return self.target
+
     def apply(self, program, new_contents, new_locations):
         engine = program.engines[self.target[0]]
         return engine.do_replace(program.contents, program.locations,
@@ -20,6 +30,9 @@ class LineReplacement(AbstractEdit):
                    program.random_target(ingr_file, 'line'))
 
 class LineInsertion(AbstractEdit):
+    def sort_key(self):
+        return self.target
+
     def apply(self, program, new_contents, new_locations):
         engine = program.engines[self.target[0]]
         return engine.do_insert(program.contents, program.locations,
@@ -36,6 +49,12 @@ class LineInsertion(AbstractEdit):
                    program.random_target(ingr_file, 'line'))
 
 class LineDeletion(AbstractEdit):
+    def overwrites(self, other):
+        return isinstance(other, (LineReplacement, LineDeletion)) and other.target == self.target
+
+    def sort_key(self):
+        return self.target
+
     def apply(self, program, new_contents, new_locations):
         engine = program.engines[self.target[0]]
         return engine.do_delete(program.contents, program.locations,
@@ -49,6 +68,9 @@ class LineDeletion(AbstractEdit):
         return cls(program.random_target(target_file, 'line'))
 
 class LineMoving(AbstractEdit):
+    def touched_files(self):
+        return {self.target[0], self.data[0][0]}
+
     def apply(self, program, new_contents, new_locations):
         engine = program.engines[self.target[0]]
         engine.do_insert(program.contents, program.locations,
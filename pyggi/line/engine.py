@@ -1,15 +1,16 @@
 from . import AbstractLineEngine
+from .buffer import LineBuffer, LineOffsets
 
 class LineEngine(AbstractLineEngine):
     @classmethod
     def get_contents(cls, file_path):
         with open(file_path, 'r') as target_file:
-            return list(map(str.rstrip, target_file.readlines()))
+            return LineBuffer(map(str.rstrip, target_file.readlines()))
 
     @classmethod
     def get_locations(cls, contents):
         n = len(contents)
-        return {'line': list(range(n)), '_inter_line': list(range(n+1))}
+        return {'line': LineOffsets(n), '_inter_line': LineOffsets(n+1)}
 
     @classmethod
     def dump(cls, contents_of_file):
@@ -40,11 +41,8 @@ class LineEngine(AbstractLineEngine):
         new_contents[d_f].insert(new_locations[d_f][d_t][d_i],
                                  contents[o_f][locations[o_f][o_t][o_i]])
         # fix locations
-        n = len(contents[d_f])
-        for i in range(d_i, n+1):
-            new_locations[d_f][d_t][i] += 1
-        for i in range(d_i, n):
-            new_locations[o_f][o_t][i] += 1
+        new_locations[d_f][d_t].shift(d_i)
+        new_locations[d_f][o_t].shift(d_i)
         return True
 
     @classmethod
@@ -30,6 +30,10 @@ class AbstractParamsEngine(AbstractEngine):
     def write_to_tmp_dir(cls, contents_of_file, tmp_path):
         pass
 
+    @classmethod
+    def write_dump_to_tmp_dir(cls, dump, tmp_path):
+        pass
+
     @classmethod
     def dump(cls, contents_of_file):
         return "\n".join(['{} := {}'.format(k, repr(v)) for k,v in contents_of_file.items() if not cls.would_be_ignored(contents_of_file, k, v)])
@@ -28,6 +28,14 @@ class AstorEngine(AbstractTreeEngine):
     def dump(cls, contents_of_file):
         return astor.to_source(contents_of_file)
 
+    @classmethod
+    def validate_dump(cls, dump, file_name):
+        try:
+            compile(dump, file_name, 'exec')
+            return True
+        except (SyntaxError, ValueError):
+            return False
+
     @classmethod
     def do_replace(cls, contents, locations, new_contents, new_locations, target_dest, target_orig):
         d_f, d_t, d_i = target_dest # file name, tag, path index
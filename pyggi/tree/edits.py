@@ -59,6 +59,9 @@ class NodeMoving(AbstractEdit):
     NODE_PARENT_TYPE = ''
     NODE_TYPE = ''
 
+    def touched_files(self):
+        return {self.target[0], self.data[0][0]}
+
     def apply(self, program, new_contents, new_locations):
         engine = program.engines[self.target[0]]
         return_code = engine.do_insert(program.contents, program.locations,
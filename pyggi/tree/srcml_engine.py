@@ -1,6 +1,11 @@
+import hashlib
+import os
 import re
+import shlex
+import subprocess
 from xml.etree import ElementTree
 
+from .. import config as pyggi_config
 from . import XmlEngine
 
 class SrcmlEngine(XmlEngine):
@@ -13,46 +18,140 @@ class SrcmlEngine(XmlEngine):
     PROCESS_PSEUDO_BLOCKS = True
     PROCESS_LITERALS = True
     PROCESS_OPERATORS = True
+    CACHE = False
+    SRCML_COMMAND = 'srcml'
+    SRCML_BATCH_SIZE = 100 # files per call
+
+    @classmethod
+    def process_key(cls):
+        options = [cls.PROCESS_PSEUDO_BLOCKS, cls.PROCESS_LITERALS, cls.PROCESS_OPERATORS,
+                   sorted((tag, sorted(tags)) for tag, tags in cls.TAG_RENAME.items()),
+                   sorted(cls.TAG_FOCUS)]
+        return '{}:{}'.format(super().process_key(), repr(options))
+
+    @classmethod
+    def read_xml_batch(cls, file_paths):
+        """
+        Read the srcML files *file_paths*. The missing ones are converted
+        from their source file (e.g., ``Triangle.java`` for
+        ``Triangle.java.xml``) by :py:meth:`srcml`, all at once, and stored in
+        the cache directory, addressed by a hash of the source code.
+
+        :return: The XML of each file
+        :rtype: list(str)
+        """
+        xmls = [None]*len(file_paths)
+        missing = []
+        for i, file_path in enumerate(file_paths):
+            if os.path.exists(file_path):
+                with open(file_path) as target_file:
+                    xmls[i] = target_file.read()
+                continue
+            source_path, ext = os.path.splitext(file_path)
+            if ext != '.xml':
+                raise ValueError()
+            with open(source_path, 'rb') as source_file:
+                source = source_file.read()
+            key = hashlib.sha1(cls.SRCML_COMMAND.encode() + b'\0' +
+                               os.path.splitext(source_path)[1].encode() + b'\0' + source)
+            cache_path = os.path.join(pyggi_config.cache_dir, 'srcml', '{}.xml'.format(key.hexdigest()))
+            try:
+                with open(cache_path) as cache_file:
+                    xmls[i] = cache_file.read()
+            except FileNotFoundError:
+                missing.append((i, source_path, cache_path))
+        if missing:
+            converted = cls.srcml([source_path for _, source_path, _ in missing])
+            for (i, _, cache_path), xml in zip(missing, converted):
+                cls.write_cache_file(cache_path, xml)
+                xmls[i] = xml
+        return xmls
+
+    @classmethod
+    def srcml(cls, source_paths):
+        """
+        Convert *source_paths* with *SRCML_COMMAND*, by batches of
+        *SRCML_BATCH_SIZE* files per call (as srcML archives)
+
+        :return: The XML of each file (without namespaces nor file names)
+        :rtype: list(str)
+        """
+        xmls = []
+        for start in range(0, len(source_paths), cls.SRCML_BATCH_SIZE):
+            batch = source_paths[start:start+cls.SRCML_BATCH_SIZE]
+            cmd = shlex.split(cls.SRCML_COMMAND) + ['--archive'] + batch
+            try:
+                result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+            except (OSError, subprocess.CalledProcessError) as e:
+                raise RuntimeError('srcML conversion failed: {}'.format(e)) from None
+            archive = cls.string_to_tree(result.stdout.decode())
+            units = {unit.get('filename'): unit for unit in archive}
+            if len(archive) != len(batch):
+                raise RuntimeError('srcML conversion failed: {} units for {} files'.format(len(archive), len(batch)))
+            for i, source_path in enumerate(batch):
+                unit = units.get(source_path, archive[i])
+                unit.tail = None
+                # only depends on the source code, as cached
+                unit.attrib.pop('filename', None)
+                unit.attrib.pop('hash', None)
+                xmls.append(cls.tree_to_string(unit))
+        return xmls
 
     @classmethod
     def process_tree(cls, tree):
+        # all the transformations are fused in a single post-order traversal:
+        # each only depends on the node itself and on its (processed) children
+        for node, preceding in cls.iter_postorder(tree):
+            cls.process_node(node, cls.guess_spacing(preceding))
+
+    @classmethod
+    def process_node(cls, element, sp_element=''):
         if cls.PROCESS_PSEUDO_BLOCKS:
-            cls.process_pseudo_blocks(tree)
+            cls.process_pseudo_block(element, sp_element)
         if cls.PROCESS_LITERALS:
-            cls.process_literals(tree)
+            cls.process_literal(element)
         if cls.PROCESS_OPERATORS:
-            cls.process_operators(tree)
+            cls.process_operator(element)
         for tag in cls.TAG_RENAME:
-            cls.rewrite_tags(tree, cls.TAG_RENAME[tag], tag)
+            if element.tag in cls.TAG_RENAME[tag]:
+                element.tag = tag
         if len(cls.TAG_FOCUS) > 0:
-            cls.focus_tags(tree, cls.TAG_FOCUS)
+            cls.unwrap_children(element, lambda child: child.tag not in cls.TAG_FOCUS)
 
     @classmethod
     def process_pseudo_blocks(cls, element, sp_element=''):
-        sp = cls.guess_spacing(element.text)
-        for child in element:
-            cls.process_pseudo_blocks(child, sp)
-            sp = cls.guess_spacing(child.tail)
+        for node, preceding in cls.iter_postorder(element):
+            cls.process_pseudo_block(node, sp_element if node is element else cls.guess_spacing(preceding))
+
+    @classmethod
+    def process_pseudo_block(cls, element, sp_element):
         if element.tag == 'block' and element.attrib.get('type') == 'pseudo':
             del element.attrib['type']
             if len(element) > 0:
                 element.text = '/*auto*/{' + (element.text or '')
+                child = element[-1]
                 child.tail = (child.tail or '') + '\n' + sp_element + '}/*auto*/'
             else:
                 element.text = '/*auto*/{' + (element.text or '') + '}/*auto*/'
 
     @classmethod
     def process_literals(cls, element):
-        for child in element:
-            cls.process_literals(child)
+        for node, _ in cls.iter_postorder(element):
+            cls.process_literal(node)
+
+    @classmethod
+    def process_literal(cls, element):
         if element.tag == 'literal':
             element.tag = 'literal_{}'.format(element.attrib.get('type'))
             del element.attrib['type']
 
     @classmethod
     def process_operators(cls, element):
-        for child in element:
-            cls.process_operators(child)
+        for node, _ in cls.iter_postorder(element):
+            cls.process_operator(node)
+
+    @classmethod
+    def process_operator(cls, element):
         if element.tag == 'operator':
             # TODO
             if element.text in ['==', '!=', '<', '<=', '>', '>=']:
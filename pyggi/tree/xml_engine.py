@@ -1,54 +1,255 @@
+import bisect
 import copy
+import hashlib
+import inspect
 import re
 import os
+from .. import config as pyggi_config
 from . import AbstractTreeEngine
+from ..line import LineOffsets
 from xml.etree import ElementTree
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+# drops namespaces (and comments/processing instructions, as ElementTree)
+STRIP_NAMESPACES_XSLT = '''<xsl:stylesheet version="1.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+  <xsl:template match="*">
+    <xsl:element name="{local-name()}">
+      <xsl:for-each select="@*">
+        <xsl:attribute name="{local-name()}"><xsl:value-of select="."/></xsl:attribute>
+      </xsl:for-each>
+      <xsl:apply-templates/>
+    </xsl:element>
+  </xsl:template>
+  <xsl:template match="text()"><xsl:copy/></xsl:template>
+  <xsl:template match="comment()|processing-instruction()"/>
+</xsl:stylesheet>'''
+
+class InsertionPoints:
+    """
+    InsertionPoints is the read-only sequence of the insertion points
+    ``(parent path, slot)`` of a list of parents, computed on demand from
+    their numbers of slots rather than stored one by one.
+    """
+    def __init__(self):
+        self.parents = []
+        self.starts = [] # index of the first slot of each parent
+        self.length = 0
+
+    def add(self, parent_path, nb_slots):
+        self.parents.append(parent_path)
+        self.starts.append(self.length)
+        self.length += nb_slots
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError('{} index out of range'.format(self.__class__.__name__))
+        k = bisect.bisect_right(self.starts, i) - 1
+        return (self.parents[k], i - self.starts[k])
+
+    def __iter__(self):
+        for k, parent_path in enumerate(self.parents):
+            end = self.starts[k+1] if k+1 < len(self.starts) else self.length
+            for slot in range(end - self.starts[k]):
+                yield (parent_path, slot)
+
+    def __eq__(self, other):
+        if isinstance(other, InsertionPoints):
+            return (self.parents, self.starts, self.length) == (other.parents, other.starts, other.length)
+        if isinstance(other, (list, tuple)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    __hash__ = None
+
+class NodeIndex(dict):
+    """
+    NodeIndex holds the locations of an XML tree, by tag. Each node is
+    identified by the positions of it and its ancestors among their siblings
+    in the original tree, e.g., ``(1, 3)``, and each insertion point by such
+    a parent node and a slot among its children, e.g., ``((1, 3), 0)``.
+
+    The location lists themselves are never modified, and shared by copies.
+    Edits instead record the slots shifted by the insertions in each parent
+    and the nodes replaced since, so that a node is found in the edited tree
+    by indexing its ancestors, and copies only depend on the number of edits.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.offsets = {} # parent path -> LineOffsets of its slots
+        self.replaced = set()
+
+    def __deepcopy__(self, memo):
+        other = self.__class__(self)
+        other.offsets = copy.deepcopy(self.offsets, memo)
+        other.replaced = set(self.replaced)
+        return other
+
+    def __eq__(self, other):
+        if isinstance(other, NodeIndex):
+            if (self.offsets, self.replaced) != (other.offsets, other.replaced):
+                return False
+        return super().__eq__(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def position(self, parent_path, slot):
+        """
+        :return: The current position of *slot* among the children of the node at *parent_path*
+        :rtype: int
+        """
+        offsets = self.offsets.get(parent_path)
+        return slot if offsets is None else offsets[slot]
+
+    def shift(self, parent_path, slot, nb_slots):
+        if parent_path not in self.offsets:
+            self.offsets[parent_path] = LineOffsets(nb_slots)
+        self.offsets[parent_path].shift(slot)
+
+    def find(self, tree, path):
+        """
+        :return: The node at *path* in *tree*, or None if it (or an ancestor)
+          was replaced or deleted
+        :rtype: :py:class:`xml.etree.ElementTree.Element`
+        """
+        if self.replaced and any(path[:j] in self.replaced for j in range(1, len(path)+1)):
+            return None
+        node = tree
+        try:
+            if not self.offsets:
+                for i in path:
+                    node = node[i]
+            else:
+                for j, i in enumerate(path):
+                    node = node[self.position(path[:j], i)]
+        except IndexError: # children removed by a deletion
+            return None
+        return node
+
 
 class XmlEngine(AbstractTreeEngine):
     INTERNODES = []
+    USE_LXML = False # if installed
+    CACHE = False # processed trees, in the cache directory
+    _strip_namespaces = None
+    _code_keys = {}
 
     @classmethod
     def process_tree(cls, tree):
         pass
 
+    @classmethod
+    def process_key(cls):
+        """
+        Describe how :py:meth:`process_tree` processes the trees, as part of
+        the keys of the cached trees; engines with processing options should
+        extend it.
+
+        :rtype: str
+        """
+        return '{}.{}@{}'.format(cls.__module__, cls.__qualname__, cls.code_key())
+
+    @classmethod
+    def code_key(cls):
+        """
+        Hash the source code of the engine classes, so that cached trees
+        are not reused once the processing code has changed.
+
+        :rtype: str
+        """
+        try:
+            return XmlEngine._code_keys[cls]
+        except KeyError:
+            pass
+        digest = hashlib.sha1()
+        for klass in cls.__mro__:
+            try:
+                digest.update(inspect.getsource(klass).encode())
+            except (OSError, TypeError): # built-in or dynamically defined
+                digest.update(klass.__qualname__.encode())
+        XmlEngine._code_keys[cls] = digest.hexdigest()
+        return XmlEngine._code_keys[cls]
+
     @classmethod
     def get_contents(cls, file_path):
-        with open(file_path) as target_file:
-            tree = cls.string_to_tree(target_file.read())
+        return cls.get_contents_batch([file_path])[0]
+
+    @classmethod
+    def get_contents_batch(cls, file_paths):
+        return [cls.xml_to_tree(xml) for xml in cls.read_xml_batch(file_paths)]
+
+    @classmethod
+    def read_xml_batch(cls, file_paths):
+        xmls = []
+        for file_path in file_paths:
+            with open(file_path) as target_file:
+                xmls.append(target_file.read())
+        return xmls
+
+    @classmethod
+    def xml_to_tree(cls, xml):
+        """
+        Parse and process *xml*. With the *CACHE* option, processed trees
+        are stored in the cache directory, addressed by a hash of *xml* and
+        of :py:meth:`process_key`, and later only parsed.
+
+        :rtype: :py:class:`xml.etree.ElementTree.Element`
+        """
+        if not cls.CACHE:
+            tree = cls.string_to_tree(xml)
+            cls.process_tree(tree)
+            return tree
+        key = hashlib.sha1('{}\0{}'.format(cls.process_key(), xml).encode()).hexdigest()
+        cache_path = os.path.join(pyggi_config.cache_dir, 'xml', '{}.xml'.format(key))
+        try:
+            with open(cache_path) as cache_file:
+                return cls.parse_string(cache_file.read())
+        except FileNotFoundError:
+            pass
+        tree = cls.string_to_tree(xml)
         cls.process_tree(tree)
+        cls.write_cache_file(cache_path, cls.tree_to_string(tree))
         return tree
 
+    @staticmethod
+    def write_cache_file(cache_path, data):
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        # written aside then renamed, as other processes may read it
+        tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+        with open(tmp_path, 'w') as cache_file:
+            cache_file.write(data)
+        os.replace(tmp_path, cache_path)
+
     @classmethod
     def get_locations(cls, contents_of_file):
-        def aux(accu, prefix, root):
-            if not cls.INTERNODES or root.tag in cls.INTERNODES:
-                for i in range(len(root)+1):
-                    s = '{}><{}'.format(prefix, i) # "><" is safe because illegal
-                    try:
-                        accu['_inter_{}'.format(root.tag)].append(s)
-                    except KeyError:
-                        accu['_inter_{}'.format(root.tag)] = [s]
-            tags = dict()
-            for child in root:
-                if child.tag in tags:
-                    tags[child.tag] += 1
-                else:
-                    tags[child.tag] = 1
-                s = '{}/{}[{}]'.format(prefix, child.tag, tags[child.tag])
-                try:
-                    accu[child.tag].append(s)
-                except KeyError:
-                    accu[child.tag] = [s]
-                accu = aux(accu, s, child)
-            return accu
-        return aux({}, '.', contents_of_file)
+        accu = NodeIndex()
+        stack = [((), contents_of_file)]
+        while stack: # pre-order
+            path, node = stack.pop()
+            if path:
+                accu.setdefault(node.tag, []).append(path)
+            if not cls.INTERNODES or node.tag in cls.INTERNODES:
+                inter = accu.setdefault('_inter_{}'.format(node.tag), InsertionPoints())
+                inter.add(path, len(node)+1)
+            stack.extend((path + (i,), child) for i, child in reversed(list(enumerate(node))))
+        return accu
 
     @classmethod
-    def write_to_tmp_dir(cls, contents_of_file, tmp_path):
+    def write_dump_to_tmp_dir(cls, dump, tmp_path):
         root, ext = os.path.splitext(tmp_path)
         if ext != '.xml':
             raise ValueError()
-        super().write_to_tmp_dir(contents_of_file, root)
+        super().write_dump_to_tmp_dir(dump, root)
 
     @classmethod
     def reset_in_tmp_dir(cls, target_file, ref_path, tmp_path):
@@ -61,114 +262,83 @@ class XmlEngine(AbstractTreeEngine):
     def dump(cls, contents_of_file):
         return cls.strip_xml_from_tree(contents_of_file)
 
-    @staticmethod
-    def string_to_tree(s):
+    @classmethod
+    def string_to_tree(cls, s):
+        if cls.USE_LXML and lxml_etree is not None:
+            if XmlEngine._strip_namespaces is None:
+                XmlEngine._strip_namespaces = lxml_etree.XSLT(lxml_etree.XML(STRIP_NAMESPACES_XSLT))
+            return XmlEngine._strip_namespaces(cls.parse_string(s)).getroot()
         xml = re.sub(r'(?:\s+xmlns[^=]*="[^"]+")+', '', s, count=1)
         xml = re.sub(r'<(/?)[^>]+:([^:>]+)>', r'<\1\2>', xml)
+        return cls.parse_string(xml)
+
+    @classmethod
+    def parse_string(cls, s):
+        """
+        Parse *s* as is (i.e., keeping namespaces)
+
+        :rtype: :py:class:`xml.etree.ElementTree.Element`
+        """
+        if cls.USE_LXML and lxml_etree is not None:
+            parser = lxml_etree.XMLParser(remove_comments=True, remove_pis=True, huge_tree=True)
+            try:
+                return lxml_etree.fromstring(s.encode(), parser)
+            except lxml_etree.XMLSyntaxError as e:
+                raise Exception('Program', 'ParseError: {}'.format(str(e))) from None
         try:
-            return ElementTree.fromstring(xml)
+            return ElementTree.fromstring(s)
         except ElementTree.ParseError as e:
             raise Exception('Program', 'ParseError: {}'.format(str(e))) from None
 
     @staticmethod
     def tree_to_string(tree):
+        if lxml_etree is not None and isinstance(tree, lxml_etree._Element):
+            return lxml_etree.tostring(tree, encoding='unicode', method='xml')
         return ElementTree.tostring(tree, encoding='unicode', method='xml')
 
     @staticmethod
     def strip_xml_from_tree(tree):
         return ''.join(tree.itertext())
 
-    @staticmethod
-    def split_xpath(xpath, prefix=None):
-        if xpath == '.':
-            raise ValueError()
-        if prefix is None:
-            pattern = re.compile(r'^(.*)/([^\[]+)(?:\[([^\]]+)\])?$')
-            match = re.match(pattern, xpath)
-            if match is None:
-                raise LookupError()
-            return (match.group(1), match.group(2), int(match.group(3)), None)
-        else:
-            if xpath[:len(prefix)+1] == prefix+'/':
-                pattern = re.compile(r'^/([^\[]+)(?:\[([^\]]+)\])?(?:/(.*))?$')
-                match = re.match(pattern, xpath[len(prefix):])
-                if match is None:
-                    raise LookupError()
-                return (prefix, match.group(1), int(match.group(2)), match.group(3))
-            else:
-                return (None, None, None, None)
-
     @classmethod
     def do_replace(cls, contents, locations, new_contents, new_locations, target_dest, target_orig):
         # get elements
-        d_f, d_t, d_i = target_dest # file name, tag, xpath index
-        o_f, o_t, o_i = target_orig # file name, tag, xpath index
-        target = new_contents[d_f].find(new_locations[d_f][d_t][d_i])
-        ingredient = contents[o_f].find(locations[o_f][o_t][o_i])
+        d_f, d_t, d_i = target_dest # file name, tag, node index
+        o_f, o_t, o_i = target_orig # file name, tag, node index
+        path = new_locations[d_f][d_t][d_i]
+        target = new_locations[d_f].find(new_contents[d_f], path)
+        ingredient = locations[o_f].find(contents[o_f], locations[o_f][o_t][o_i])
         if target is None or ingredient is None:
             return False
         if cls.tree_to_string(target) == cls.tree_to_string(ingredient):
             return False
 
         # mutate
-        old_tag = target.tag
         old_tail = target.tail
         target.clear() # to remove children
         target.tag = ingredient.tag
-        target.attrib = ingredient.attrib
+        target.attrib.update(ingredient.attrib)
         target.text = ingredient.text
         target.tail = old_tail
         for child in ingredient:
             target.append(copy.deepcopy(child))
 
         # update modification points
-        if old_tag != ingredient.tag:
-            head, tag, pos, _ = cls.split_xpath(new_locations[d_f][d_t][d_i])
-            itag = 1
-            for i, xpath in enumerate(new_locations[d_f][d_t]):
-                h, t, p, s = cls.split_xpath(xpath, head)
-                if i < d_i:
-                    if h != head:
-                        continue
-                    elif t == ingredient.tag:
-                        itag += 1
-                elif i == d_i:
-                    new_locations[d_f][i] = '{}/{}[{}]'.format(h, ingredient.tag, itag)
-                elif h != head:
-                    break
-                elif t == tag:
-                    if p == pos:
-                        new_pos = 'deleted'
-                    elif s:
-                        new_pos = '{}/{}[{}]/{}'.format(h, t, p-1, s)
-                    else:
-                        new_pos = '{}/{}[{}]'.format(h, t, p-1)
-                    new_locations[d_f][i] = new_pos
-                elif t == ingredient.tag:
-                    if s:
-                        new_pos = '{}/{}[{}]/{}'.format(h, t, p+1, s)
-                    else:
-                        new_pos = '{}/{}[{}]'.format(h, t, p+1)
-                    new_locations[d_f][i] = new_pos
-        xpath = new_locations[d_f][d_t][d_i]
-        for i, xpath_inter in enumerate(new_locations[d_f][d_t]):
-            if xpath_inter[:len(xpath)] == xpath:
-                new_locations[d_f][d_t][i] = 'deleted'
+        new_locations[d_f].replaced.add(path)
         return True
 
     @classmethod
     def do_insert(cls, contents, locations, new_contents, new_locations, target_dest, target_orig):
         # get elements
-        d_f, d_t, d_i = target_dest # file name, tag, xpath index
-        o_f, o_t, o_i = target_orig # file name, tag, xpath index
-        if new_locations[d_f][d_t][d_i] == 'deleted':
-            return False
-        parent_xpath, insert_index = new_locations[d_f][d_t][d_i].split('><')
-        insert_index = int(insert_index)
-        parent = new_contents[d_f].find(parent_xpath)
-        ingredient = contents[o_f].find(locations[o_f][o_t][o_i])
+        d_f, d_t, d_i = target_dest # file name, tag, insertion point index
+        o_f, o_t, o_i = target_orig # file name, tag, node index
+        parent_path, slot = new_locations[d_f][d_t][d_i]
+        parent = new_locations[d_f].find(new_contents[d_f], parent_path)
+        ingredient = locations[o_f].find(contents[o_f], locations[o_f][o_t][o_i])
         if parent is None or ingredient is None:
             return False
+        insert_index = new_locations[d_f].position(parent_path, slot)
+        nb_slots = len(parent)+1
 
         # mutate
         sp = cls.guess_spacing(parent.text)
@@ -188,30 +358,14 @@ class XmlEngine(AbstractTreeEngine):
                 raise RuntimeError
 
         # update modification points
-        for i, xpath in enumerate(new_locations[d_f][o_t]):
-            if xpath == 'deleted':
-                continue
-            h, t, p, s = cls.split_xpath(xpath, parent_xpath)
-            if h != parent_xpath or t != ingredient.tag or p < insert_index:
-                continue
-            if s:
-                new_pos = '{}/{}[{}]/{}'.format(h, t, p+1, s)
-            else:
-                new_pos = '{}/{}[{}]'.format(h, t, p+1)
-            new_locations[d_f][o_t][i] = new_pos
-        for i, xpath_inter in enumerate(new_locations[d_f][d_t]):
-            xpath, index = xpath_inter.split('><')
-            index = int(index)
-            if xpath != parent_xpath or index < insert_index:
-                continue
-            new_locations[d_f][d_t][i] = '{}><{}'.format(xpath, index+1)
+        new_locations[d_f].shift(parent_path, slot, nb_slots)
         return True
 
     @classmethod
     def do_delete(cls, contents, locations, new_contents, new_locations, target):
         # get elements
-        d_f, d_t, d_i = target # file name, tag, xpath index
-        target = new_contents[d_f].find(new_locations[d_f][d_t][d_i])
+        d_f, d_t, d_i = target # file name, tag, node index
+        target = new_locations[d_f].find(new_contents[d_f], new_locations[d_f][d_t][d_i])
         if target is None:
             return False
         if len(target) == 0 and target.text == None: # (probably) already deleted
@@ -227,8 +381,8 @@ class XmlEngine(AbstractTreeEngine):
 
     @classmethod
     def do_set_text(cls, contents, locations, new_contents, new_locations, target, value):
-        d_f, d_t, d_i = target # file name, tag, xpath index
-        target = new_contents[d_f].find(new_locations[d_f][d_t][d_i])
+        d_f, d_t, d_i = target # file name, tag, node index
+        target = new_locations[d_f].find(new_contents[d_f], new_locations[d_f][d_t][d_i])
         if target is None or target.text == value:
             return False
         else:
@@ -237,100 +391,101 @@ class XmlEngine(AbstractTreeEngine):
 
     @classmethod
     def do_wrap_text(cls, contents, locations, new_contents, new_locations, target, prefix, suffix):
-        d_f, d_t, d_i = target # file name, tag, xpath index
-        target = new_contents[d_f].find(new_locations[d_f][d_t][d_i])
+        d_f, d_t, d_i = target # file name, tag, node index
+        target = new_locations[d_f].find(new_contents[d_f], new_locations[d_f][d_t][d_i])
         if target is None:
             return False
         else:
             target.text = prefix + (target.text or '') + suffix
             return True
 
+    @staticmethod
+    def iter_postorder(element):
+        """
+        Iterate over the nodes of *element* (included) in post-order, without
+        recursion, with the text preceding each of them (i.e., the text of
+        its parent or the tail of its previous sibling, None for *element*)
+        read before any of them is visited. The descendants of a node may be
+        modified when it is visited.
+
+        :return: The pairs of a node and its preceding text
+        :rtype: iterator(tuple(:py:class:`xml.etree.ElementTree.Element`, str))
+        """
+        stack = [(element, None, iter(element))]
+        preceding = [element.text]
+        while stack:
+            node, node_preceding, children = stack[-1]
+            child = next(children, None)
+            if child is not None:
+                stack.append((child, preceding[-1], iter(child)))
+                preceding[-1] = child.tail
+                preceding.append(child.text)
+            else:
+                stack.pop()
+                preceding.pop()
+                yield node, node_preceding
+
     @classmethod
     def focus_tags(cls, element, tags):
-        last = None
-        marked = []
-        buff = 0
-        for i, child in enumerate(element):
-            cls.focus_tags(child, tags)
-            if child.tag not in tags:
-                marked.append(child)
-                if child.text:
-                    if last is not None:
-                        last.tail = (last.tail or '') + child.text
-                    else:
-                        element.text = (element.text or '') + child.text
-                if len(child) > 0:
-                    for sub_child in reversed(child):
-                        element.insert(i+1, sub_child)
-                    last = child[-1]
-                if child.tail:
-                    if last is not None:
-                        last.tail = (last.tail or '') + child.tail
-                    else:
-                        element.text = (element.text or '') + child.tail
-            else:
-                last = child
-        for child in marked:
-            element.remove(child)
+        for node, _ in cls.iter_postorder(element):
+            cls.unwrap_children(node, lambda child: child.tag not in tags)
 
     @classmethod
     def remove_tags(cls, element, tags):
         if len(tags) == 0:
             return
-        last = None
-        marked = []
-        buff = 0
         remove_all = '*' in tags
-        for i, child in enumerate(element):
-            cls.remove_tags(child, tags)
-            if remove_all or child.tag in tags:
-                marked.append(child)
-                if child.text:
-                    if last is not None:
-                        last.tail = (last.tail or '') + child.text
-                    else:
-                        element.text = (element.text or '') + child.text
-                if len(child) > 0:
-                    for sub_child in reversed(child):
-                        element.insert(i+1, sub_child)
-                    last = child[-1]
-                if child.tail:
-                    if last is not None:
-                        last.tail = (last.tail or '') + child.tail
-                    else:
-                        element.text = (element.text or '') + child.tail
+        for node, _ in cls.iter_postorder(element):
+            cls.unwrap_children(node, lambda child: remove_all or child.tag in tags)
+
+    @classmethod
+    def unwrap_children(cls, element, predicate):
+        """
+        Replace the children of *element* matching *predicate* by their own
+        children, keeping their text in place. The children are rebuilt at
+        once rather than moved one by one, as moving a node detaches it from
+        its parent with lxml but not with ElementTree.
+        """
+        children = []
+        def append_text(text):
+            if not text:
+                return
+            if children:
+                children[-1].tail = (children[-1].tail or '') + text
+            else:
+                element.text = (element.text or '') + text
+        changed = False
+        for child in list(element):
+            if predicate(child):
+                changed = True
+                tail = child.tail
+                append_text(child.text)
+                children.extend(child)
+                append_text(tail)
             else:
-                last = child
-        for child in marked:
-            element.remove(child)
+                children.append(child)
+        if changed:
+            element[:] = children
 
     @classmethod
     def get_tags(cls, element):
-        def aux(element, accu):
-            accu.append(element.tag)
-            for child in element:
-                aux(child, accu)
-            return set(accu)
-        return aux(element, [])
+        return set(node.tag for node in element.iter())
 
     @classmethod
     def count_tags(cls, element):
-        def aux(element, accu):
+        accu = {}
+        for node in element.iter():
             try:
-                accu[element.tag] += 1
+                accu[node.tag] += 1
             except KeyError:
-                accu[element.tag] = 1
-            for child in element:
-                aux(child, accu)
-            return accu
-        return aux(element, {})
+                accu[node.tag] = 1
+        return accu
 
     @classmethod
     def rewrite_tags(cls, element, tags, new_tag):
-        if element.tag in tags:
-            element.tag = new_tag
-        for child in element:
-            cls.rewrite_tags(child, tags, new_tag)
+        for node in element.iter():
+            if node.tag in tags:
+                node.tag = new_tag
 
     @classmethod
     def rotate_newlines(cls, element):
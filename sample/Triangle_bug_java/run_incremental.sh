@@ -0,0 +1,9 @@
+#!/bin/sh
+set -e
+
+# Triangle classes are restored (or removed when stale) by pyggi, see the
+# build_artifacts option: only missing classes are compiled again.
+
+[ -f Triangle.class ] || javac -cp "./junit-4.10.jar" Triangle.java
+[ -f TriangleTest.class ] || javac -cp "./junit-4.10.jar:./" TriangleTest.java TestRunner.java
+java -cp "./junit-4.10.jar:./" TestRunner TriangleTest
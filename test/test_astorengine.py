@@ -51,6 +51,13 @@ def test_dump(file_contents, engine_contents):
         l1, l2 = dump_list.pop(0), orig_list.pop(0)
         assert l1 == l2 or (l1 == l2[:len(l1)] and orig_line[len(l1)] == '#') # close enough?
 
+def test_validate_dump(engine_contents):
+    file_name = 'triangle.py'
+    dump = AstorEngine.dump(engine_contents[file_name])
+    assert AstorEngine.validate_dump(dump, file_name)
+    assert not AstorEngine.validate_dump(dump + '\nreturn 0\n', file_name)
+    assert not AstorEngine.validate_dump(dump + '\nif True\n', file_name)
+
 def test_deletion1(engine_contents, engine_locations):
     """Deletion should work"""
     file_name = 'triangle.py'
@@ -0,0 +1,238 @@
+import multiprocessing
+import pickle
+import pytest
+import threading
+
+from pyggi.base import Patch, RunResult, SqliteCache, SharedCache, LRUCache, LFUCache
+from pyggi.base.cache import AbstractMemoryCache
+from pyggi.line import LineProgram, LineDeletion
+from pyggi.algo import DummySearch
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = SqliteCache(str(tmp_path / 'cache' / 'runs.sqlite'))
+    yield cache
+    cache.close()
+
+def test_get_set(cache):
+    assert cache.get('ns', 'key') is None
+    cache.set('ns', 'key', RunResult('SUCCESS', 42))
+    run = cache.get('ns', 'key')
+    assert run.status == 'SUCCESS'
+    assert run.fitness == 42
+    assert cache.get('other', 'key') is None
+    cache.set('ns', 'key', RunResult('TIMEOUT'))
+    assert cache.get('ns', 'key').status == 'TIMEOUT'
+    assert len(cache) == 1
+    cache.clear('other')
+    assert len(cache) == 1
+    cache.clear()
+    assert len(cache) == 0
+
+def test_persistence(cache):
+    cache.set('ns', 'key', RunResult('SUCCESS', 1))
+    other = SqliteCache(cache.path)
+    try:
+        assert other.get('ns', 'key').fitness == 1
+    finally:
+        other.close()
+
+def test_timeout(tmp_path):
+    cache = SqliteCache(str(tmp_path / 'runs.sqlite'), timeout=2.5)
+    try:
+        assert cache.connect().execute('PRAGMA busy_timeout').fetchone()[0] == 2500
+    finally:
+        cache.close()
+
+def test_concurrent(cache):
+    def work(i):
+        other = SqliteCache(cache.path)
+        for j in range(20):
+            other.set('ns', '{}-{}'.format(i, j), RunResult('SUCCESS', j))
+            cache.get('ns', '{}-{}'.format(i, j))
+        other.close()
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(cache) == 80
+
+def shared_cache_worker(cache, i):
+    cache.set('ns', str(i), RunResult('SUCCESS', i))
+
+def test_shared_cache(tmp_path):
+    cache = SharedCache(str(tmp_path / 'shared.cache'), nb_slots=64, slot_size=256)
+    try:
+        assert cache.get('ns', 'key') is None
+        assert cache.set('ns', 'key', RunResult('SUCCESS', 42))
+        assert cache.get('ns', 'key').fitness == 42
+        assert cache.get('other', 'key') is None
+        assert not cache.set('ns', 'big', RunResult('SUCCESS', 'x'*1000))
+        assert cache.get('ns', 'big') is None
+        processes = [multiprocessing.Process(target=shared_cache_worker, args=(cache, i)) for i in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        assert all(cache.get('ns', str(i)).fitness == i for i in range(4))
+        other = pickle.loads(pickle.dumps(cache))
+        assert other.get('ns', 'key').fitness == 42
+        other.close()
+        for i in range(200): # full: overwrites
+            cache.set('ns', 'many{}'.format(i), RunResult('SUCCESS', i))
+        assert len(cache) == 64
+        assert cache.get('ns', 'many199').fitness == 199
+    finally:
+        cache.close()
+
+def test_abstract_memory_cache():
+    with pytest.raises(TypeError):
+        AbstractMemoryCache()
+    class PartialCache(AbstractMemoryCache):
+        def get(self, key):
+            return None
+    with pytest.raises(TypeError):
+        PartialCache()
+
+def test_lru():
+    cache = LRUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert 'b' not in cache
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.evictions == 1
+    assert len(cache) == 2
+
+def test_lfu():
+    cache = LFUCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.get('a')
+    cache.set('c', 3)
+    assert 'b' not in cache
+    assert 'c' in cache
+    cache.set('d', 4)
+    assert 'c' not in cache
+    assert cache.get('a') == 1
+    assert cache.evictions == 2
+
+def test_lfu_aging():
+    cache = LFUCache(maxsize=2)
+    cache.set('old', 0)
+    for _ in range(3):
+        cache.get('old')
+    for i in range(10):
+        cache.set(i, i)
+        cache.get(i)
+    assert 'old' not in cache
+    assert len(cache) == 2
+
+def test_maxbytes():
+    run = RunResult('SUCCESS', 1)
+    size = LRUCache.sizeof('key0', run)
+    cache = LRUCache(maxbytes=3*size)
+    for i in range(10):
+        cache.set('key{}'.format(i), run)
+    assert len(cache) == 3
+    assert cache.nbytes <= 3*size
+    assert cache.evictions == 7
+
+def test_algorithm_policy():
+    search = DummySearch()
+    search.config['cache_maxsize'] = 3
+    search.config['cache_policy'] = 'lru'
+    for i in range(5):
+        search.cache_set(str(i), RunResult('SUCCESS', i))
+    assert isinstance(search.get_cache(), LRUCache)
+    assert search.stats['cache_evictions'] == 2
+    assert search.cache_get('0') is None
+    assert search.cache_get('4').fitness == 4
+    assert (search.stats['cache_hits'], search.stats['cache_misses']) == (1, 1)
+    search.cache_reset()
+    search.config['cache_policy'] = 'unknown'
+    with pytest.raises(ValueError):
+        search.get_cache()
+
+def test_algorithm_shared(tmp_path):
+    config = {
+        'target_files': ["triangle.py"],
+        'test_command': "echo 1",
+    }
+    program = LineProgram('../sample/Triangle_bug_python', config=config)
+    patch = Patch([LineDeletion(('triangle.py', 'line', 1))])
+    try:
+        search = DummySearch()
+        search.program = program
+        search.config['shared_cache'] = str(tmp_path / 'shared.cache')
+        search.config['disk_cache'] = str(tmp_path / 'runs.sqlite')
+        assert search.evaluate_patch(patch).fitness == 1
+        other = DummySearch()
+        other.program = program
+        other.config['disk_cache'] = str(tmp_path / 'runs.sqlite')
+        other.cache_copy(search)
+        other.cache_reset()
+        assert other.evaluate_patch(patch).fitness == 1
+        assert other.stats['shared_cache_hits'] == 1
+        assert other.stats['disk_cache_hits'] == 0
+        search.shared_cache.close()
+        search.disk_cache.close()
+    finally:
+        program.clean_work_dir()
+
+def test_algorithm(tmp_path):
+    config = {
+        'target_files': ["triangle.py"],
+        'test_command': "echo 1",
+    }
+    program = LineProgram('../sample/Triangle_bug_python', config=config)
+    patch = Patch([LineDeletion(('triangle.py', 'line', 1))])
+    path = str(tmp_path / 'runs.sqlite')
+    try:
+        search = DummySearch()
+        search.program = program
+        search.config['disk_cache'] = path
+        assert search.evaluate_patch(patch).fitness == 1
+        assert search.stats['cache_misses'] == 1
+        search = DummySearch()
+        search.program = program
+        search.config['disk_cache'] = path
+        assert search.evaluate_patch(patch).fitness == 1
+        assert search.stats['disk_cache_hits'] == 1
+        program.test_command = "echo 2"
+        assert search.evaluate_patch(patch).fitness == 1 # in memory
+        search.cache_reset()
+        assert search.evaluate_patch(patch).fitness == 2
+        search.disk_cache.close()
+    finally:
+        program.clean_work_dir()
+
+def test_algorithm_timeout(tmp_path):
+    config = {
+        'target_files': ["triangle.py"],
+        'test_command': "sh -c 'sleep 0.5; echo 1'",
+    }
+    program = LineProgram('../sample/Triangle_bug_python', config=config)
+    patch = Patch([LineDeletion(('triangle.py', 'line', 1))])
+    path = str(tmp_path / 'runs.sqlite')
+    try:
+        search = DummySearch()
+        search.program = program
+        search.config['disk_cache'] = path
+        program.timeout = 0.1
+        assert search.evaluate_patch(patch).status == 'TIMEOUT'
+        assert search.evaluate_patch(patch).status == 'TIMEOUT' # in memory
+        assert len(search.disk_cache) == 0
+        search = DummySearch()
+        search.program = program
+        search.config['disk_cache'] = path
+        program.timeout = 5
+        assert search.evaluate_patch(patch).fitness == 1
+        assert search.stats['disk_cache_hits'] == 0
+        search.disk_cache.close()
+    finally:
+        program.clean_work_dir()
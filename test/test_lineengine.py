@@ -2,7 +2,7 @@ import copy
 import os
 import pytest
 
-from pyggi.line import LineEngine
+from pyggi.line import LineEngine, LineBuffer, LineOffsets
 from util import assert_diff
 
 @pytest.fixture
@@ -196,3 +196,38 @@ def test_insertion3(engine_contents, engine_locations):
          a = b
 """
     assert_diff(dump, new_dump, expected)
+
+def test_buffer():
+    """Buffers should behave like lists"""
+    lines = ['a', 'b', 'c', 'd']
+    buffer = LineBuffer(lines)
+    assert buffer == lines
+    other = copy.deepcopy(buffer)
+    other[1] = None
+    other.insert(0, 'x')
+    other.insert(5, 'y')
+    other.insert(3, 'z')
+    other[-1] = 'w'
+    lines2 = ['x', 'a', None, 'z', 'c', 'd', 'w']
+    assert other == lines2
+    assert [other[i] for i in range(len(other))] == lines2
+    assert buffer == lines
+    assert LineEngine.dump(other) == 'x\na\nz\nc\nd\nw\n'
+    third = copy.deepcopy(other)
+    third[0] = 'v'
+    assert third[0] == 'v' and other[0] == 'x'
+    with pytest.raises(IndexError):
+        other[7]
+
+def test_offsets():
+    """Offsets should shift the following indices"""
+    offsets = LineOffsets(6)
+    assert offsets == list(range(6))
+    other = copy.deepcopy(offsets)
+    other.shift(4)
+    other.shift(2)
+    other.shift(4)
+    assert other == [0, 1, 3, 4, 7, 8]
+    assert other[-1] == 8
+    assert offsets == list(range(6))
+    assert len(other) == 6
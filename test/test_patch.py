@@ -1,7 +1,8 @@
 import pytest
+import random
 from pyggi.base import Patch
 from pyggi.line import LineProgram
-from pyggi.line import LineDeletion, LineMoving, LineInsertion
+from pyggi.line import LineDeletion, LineMoving, LineInsertion, LineReplacement
 
 @pytest.fixture(scope='session')
 def setup():
@@ -73,3 +74,41 @@ class TestPatch(object):
 
         assert len(patch) == len(old_patch) - 1
         assert patch.edit_list == old_patch.edit_list[1:]
+
+    def test_canonical(self, setup):
+        _, program = setup
+        f = 'Triangle.java'
+        deletion = LineDeletion((f, 'line', 3))
+        replacement = LineReplacement((f, 'line', 3), (f, 'line', 5))
+        insertion = LineInsertion((f, '_inter_line', 7), (f, 'line', 1))
+        assert Patch([deletion, deletion]).canonical() == Patch([deletion])
+        assert Patch([replacement, deletion]).canonical() == Patch([deletion])
+        assert Patch([deletion, replacement]).canonical() == Patch([replacement])
+        assert Patch([deletion, LineReplacement((f, 'line', 3), (f, 'line', 3))]).canonical() == Patch()
+        assert Patch([replacement, insertion]).canonical() == Patch([insertion, replacement]).canonical()
+        moving = LineMoving((f, '_inter_line', 7), (f, 'line', 1))
+        assert Patch([replacement, moving]).canonical() == Patch([replacement, moving])
+        restore = LineReplacement((f, 'line', 1), (f, 'line', 1))
+        assert Patch([moving, restore]).canonical() == Patch([moving, restore])
+        assert program.variant_key(Patch([moving, restore])) != program.variant_key(Patch([moving]))
+
+    def test_canonical_variant(self, setup):
+        _, program = setup
+        f = 'Triangle.java'
+        n = len(program.contents[f])
+        rng = random.Random(0)
+        def random_edit():
+            i, j = rng.randrange(6), rng.randrange(n) # collisions on purpose
+            return rng.choice([
+                LineDeletion((f, 'line', i)),
+                LineReplacement((f, 'line', i), (f, 'line', rng.choice([i, j]))),
+                LineInsertion((f, '_inter_line', rng.randrange(7)), (f, 'line', j)),
+                LineMoving((f, '_inter_line', rng.randrange(7)), (f, 'line', rng.choice([i, j]))),
+            ])
+        for _ in range(200):
+            patch = Patch([random_edit() for _ in range(rng.randrange(1, 8))])
+            canonical = patch.canonical()
+            assert len(canonical) <= len(patch)
+            assert canonical.canonical() == canonical
+            expected = program.dump_contents(program.get_modified_contents(patch))
+            assert program.dump_contents(program.get_modified_contents(canonical)) == expected
@@ -1,14 +1,20 @@
+import ast
+import asyncio
+import copy
 import os
 import pytest
 import random
 import re
+import shlex
 import shutil
+import time
 
 import pyggi
 pyggi.config.enable_astor = True
 
 from pyggi.base import Patch
-from pyggi.line import LineProgram, LineInsertion, LineEngine
+from pyggi.algo import DummySearch
+from pyggi.line import LineProgram, LineInsertion, LineDeletion, LineEngine
 from pyggi.tree import TreeProgram, StmtInsertion, AstorEngine
 
 class MyLineProgram(LineProgram):
@@ -108,11 +114,294 @@ class TestLineProgram(object):
         file_contents = open(os.path.join(program.work_path, 'triangle.py'), 'r').read()
         assert file_contents == program.dump(program.get_modified_contents(patch), 'triangle.py')
 
+    def test_exec_cmd_rusage(self, setup_line):
+        program = setup_line
+        cmd = ['python', '-c', 'x = bytearray(50 << 20); sum(range(10**6))']
+        return_code, _, _, _, rusage = program.exec_cmd(cmd, rusage=True)
+        assert return_code == 0
+        assert rusage['cpu_time'] == rusage['user_time'] + rusage['system_time'] > 0
+        assert rusage['max_rss'] > 50 << 10
+        return_code, _, _, _, rusage = program.exec_cmd(['sleep', '5'], timeout=0.5, rusage=True)
+        assert return_code is None
+        assert rusage['cpu_time'] < 0.5
+        run = program.evaluate_patch(Patch())
+        assert run.cpu_time > 0
+
+    def test_limit_command(self):
+        config = {
+            'target_files': ["triangle.py"],
+            'test_command': "pytest -s test_triangle.py",
+            'nb_workers': 2,
+            'cpu_affinity': 'auto',
+            'rlimits': {'nofile': 64, 'fsize': (1000, 1000)},
+        }
+        program = MyLineProgram('../sample/Triangle_bug_python', config=config)
+        cores = os.sched_getaffinity(0)
+        cpu_sets = [program.get_cpu_set(work_path) for work_path in program.work_paths]
+        assert all(cpu_set and cpu_set <= cores for cpu_set in cpu_sets)
+        if len(cores) > 1:
+            assert not cpu_sets[0] & cpu_sets[1]
+        # inherited by the processes started by the command
+        cmd = ['sh', '-c', 'python -c "import os, resource; print(sorted(os.sched_getaffinity(0)), resource.getrlimit(resource.RLIMIT_NOFILE)[0])"']
+        _, stdout, _, _ = program.exec_cmd(program.limit_command(cmd, program.work_paths[1]))
+        assert stdout.decode('ascii').strip() == '{} 64'.format(sorted(cpu_sets[1]))
+        cmd = ['python', '-c', 'open("big", "w").write("x" * 10000)']
+        return_code, _, _, _ = program.exec_cmd(program.limit_command(cmd), cwd=program.work_path)
+        assert return_code != 0
+        return_code, _, stderr, _ = program.exec_cmd(program.limit_command(['no-such-command']))
+        assert return_code == 127
+        assert b'no-such-command' in stderr
+        program.rlimits = {}
+        program.cpu_affinity = None
+        assert program.limit_command(cmd) == cmd
+        cmd = ['python', '-c', 'import os; print(os.getsid(0) == os.getpid())']
+        _, stdout, _, _ = program.exec_cmd(cmd)
+        assert stdout.decode('ascii').strip() == 'True'
+        program.clean_work_dir()
+
+    def test_set_current(self, setup_line):
+        program = setup_line
+        rng = random.Random(0)
+        n = len(program.contents['triangle.py'])
+        def random_edit():
+            return rng.choice([
+                LineDeletion(('triangle.py', 'line', rng.randrange(n))),
+                LineInsertion(('triangle.py', '_inter_line', rng.randrange(n+1)), ('triangle.py', 'line', rng.randrange(n))),
+            ])
+        current = Patch([random_edit() for _ in range(5)])
+        program.set_current(current)
+        try:
+            for _ in range(20):
+                patch = current.clone()
+                for _ in range(rng.randrange(1, 3)):
+                    patch.add(random_edit())
+                dumps = program.get_incremental_dumps(patch)
+                assert dumps == program.dump_contents(program.get_modified_contents(patch))
+                assert program.get_incremental_dumps(current) == program.dump_contents(program.get_modified_contents(current))
+            assert program.get_incremental_dumps(Patch(current.edit_list[1:])) is None
+        finally:
+            program.set_current(None)
+        assert program.get_incremental_dumps(current) is None
+
+    def test_copy_on_write(self):
+        config = {
+            'target_files': ["triangle.py", "test_triangle.py"],
+            'test_command': "pytest -s test_triangle.py",
+        }
+        program = MyLineProgram('../sample/Triangle_bug_python', config=config)
+        original = copy.deepcopy(program.contents)
+        patch = Patch([LineDeletion(('triangle.py', 'line', 1))])
+        contents, locations = program.get_modified_state(patch)
+        assert contents['test_triangle.py'] is program.contents['test_triangle.py']
+        assert locations['test_triangle.py'] is program.locations['test_triangle.py']
+        assert contents['triangle.py'] is not program.contents['triangle.py']
+        assert contents['triangle.py'][1] is None
+        assert program.contents == original
+        program.clean_work_dir()
+
+    def test_dumps_untouched_files(self):
+        config = {
+            'target_files': ["triangle.py", "test_triangle.py"],
+            'test_command': "pytest -s test_triangle.py",
+        }
+        program = MyLineProgram('../sample/Triangle_bug_python', config=config)
+        original_dumps = program.get_original_dumps()
+        dumped = []
+        dump = program.dump
+        def counting_dump(contents, file_name):
+            dumped.append(file_name)
+            return dump(contents, file_name)
+        program.dump = counting_dump
+        patch = Patch([LineDeletion(('triangle.py', 'line', 1))])
+        dumps = program.get_modified_dumps(patch)
+        assert dumped == ['triangle.py']
+        assert dumps['test_triangle.py'] is original_dumps['test_triangle.py']
+        assert dumps == program.dump_contents(program.get_modified_contents(patch))
+        program.clean_work_dir()
+
+    def test_algorithm_evaluate_patches_memo(self):
+        config = {
+            'target_files': ["triangle.py"],
+            'test_command': "echo 1",
+        }
+        program = LineProgram('../sample/Triangle_bug_python', config=config)
+        applied = []
+        get_modified_state = program.get_modified_state
+        def counting_get_modified_state(patch):
+            applied.append(str(patch))
+            return get_modified_state(patch)
+        program.get_modified_state = counting_get_modified_state
+        search = DummySearch()
+        search.program = program
+        search.reset()
+        patches = [Patch([LineDeletion(('triangle.py', 'line', i))]) for i in range(2*program.dumps_memo_size)]
+        results = list(search.evaluate_patches(patches))
+        assert all(run.fitness == 1 for _, run in results)
+        assert sorted(applied) == sorted(str(patch) for patch in patches)
+        assert program.dumps_memo_size == 16
+        program.clean_work_dir()
+
+    def test_apply_incremental(self, setup_line):
+        program = setup_line
+        patch = Patch([LineInsertion(('triangle.py', '_inter_line', 1), ('triangle.py', 'line', 10))])
+        program.apply(patch)
+        marker = os.path.join(program.work_path, 'marker')
+        open(marker, 'w').close()
+        program.apply(Patch())
+        assert os.path.exists(marker)
+        file_contents = open(os.path.join(program.work_path, 'triangle.py'), 'r').read()
+        assert file_contents == program.dump(program.contents, 'triangle.py')
+        os.remove(marker)
+
+    def test_check_tmp_variant(self, setup_line):
+        program = setup_line
+        program.variant_check = True
+        try:
+            program.apply(Patch())
+            assert program.check_tmp_variant()
+            test_file = os.path.join(program.work_path, 'test_triangle.py')
+            with open(test_file, 'a') as f:
+                f.write('# modified\n')
+            assert not program.check_tmp_variant()
+            program.apply(Patch())
+            with open(test_file, 'r') as f:
+                assert '# modified' not in f.read()
+        finally:
+            program.variant_check = False
+
+    def test_copy_mode_link(self):
+        config = {
+            'target_files': ["triangle.py"],
+            'test_command': "pytest -s test_triangle.py",
+            'copy_mode': 'link',
+        }
+        program = MyLineProgram('../sample/Triangle_bug_python', config=config)
+        original = os.path.join(program.path, 'triangle.py')
+        with open(original) as f:
+            original_contents = f.read()
+        assert not os.path.samefile(original, os.path.join(program.work_path, 'triangle.py'))
+        with open(os.path.join(program.work_path, 'test_triangle.py')) as f:
+            with open(os.path.join(program.path, 'test_triangle.py')) as g:
+                assert f.read() == g.read()
+        patch = Patch([LineInsertion(('triangle.py', '_inter_line', 1), ('triangle.py', 'line', 10))])
+        program.apply(patch)
+        with open(original) as f:
+            assert f.read() == original_contents
+        program.clean_work_dir()
+
+    def test_harness(self, setup_line):
+        harness_path = os.path.abspath('../example/pytest_harness.py')
+        config = {
+            'target_files': ["triangle.py"],
+            'test_command': "pytest -s test_triangle.py",
+            'harness_command': "python {} -s test_triangle.py".format(harness_path),
+        }
+        program = MyLineProgram('../sample/Triangle_bug_python', config=config)
+        try:
+            run = program.evaluate_patch(Patch())
+            assert run.status == 'SUCCESS'
+            assert run.fitness == setup_line.evaluate_patch(Patch()).fitness
+            pid = program.get_harness().process.pid
+            run = program.evaluate_patch(Patch())
+            assert run.status == 'SUCCESS'
+            assert program.get_harness().process.pid == pid
+        finally:
+            program.clean_work_dir()
+
+    def test_harness_rlimits(self):
+        # each evaluation burns ~0.4s of CPU time, more than 1s overall
+        cmd = "import json, sys, time\nfor line in sys.stdin:\n    end = time.process_time() + 0.4\n    while time.process_time() < end: pass\n    print(json.dumps({'return_code': 0, 'stdout': 'runtime: 0'}), flush=True)"
+        config = {
+            'target_files': ["triangle.py"],
+            'test_command': "pytest -s test_triangle.py",
+            'harness_command': "python -c {}".format(shlex.quote(cmd)),
+            'rlimits': {'cpu': 1},
+        }
+        program = MyLineProgram('../sample/Triangle_bug_python', config=config)
+        try:
+            pid = None
+            for _ in range(4):
+                run = program.evaluate_patch(Patch())
+                assert run.status == 'SUCCESS'
+                assert pid in (None, program.get_harness().process.pid)
+                pid = program.get_harness().process.pid
+        finally:
+            program.clean_work_dir()
+
+    def test_harness_restart(self, setup_line):
+        config = {
+            'target_files': ["triangle.py"],
+            'test_command': "pytest -s test_triangle.py",
+            'harness_command': "python -c 'import sys, time; sys.stdin.readline(); time.sleep(5)'",
+        }
+        program = MyLineProgram('../sample/Triangle_bug_python', config=config)
+        try:
+            run = program.evaluate_patch(Patch(), timeout=0.5)
+            assert run.status == 'TIMEOUT'
+            assert not program.get_harness().is_running()
+            program.harness_command = "python -c 'import sys; sys.stdin.readline()'"
+            program.stop_harnesses()
+            run = program.evaluate_patch(Patch())
+            assert run.status == 'PARSE_ERROR'
+            assert not program.get_harness().is_running()
+        finally:
+            program.clean_work_dir()
+
     def test_exec_cmd(self, setup_line):
         program = setup_line
         _, stdout, _, _ = program.exec_cmd(['echo', 'hello'])
         assert stdout.decode('ascii').strip() == "hello"
 
+    def test_exec_cmd_timeout(self, setup_line):
+        program = setup_line
+        return_code, _, _, elapsed_time = program.exec_cmd(['sleep', '5'], timeout=0.5)
+        assert return_code is None
+        assert 0.5 <= elapsed_time < 1.5
+
+    def test_exec_cmd_kill_group(self, setup_line):
+        program = setup_line
+        cmd = ['sh', '-c', 'sleep 30 & echo $!; wait']
+        return_code, stdout, _, _ = program.exec_cmd(cmd, timeout=0.5, max_pipesize=None)
+        assert return_code is None
+        pid = int(stdout)
+        for _ in range(100):
+            try:
+                with open('/proc/{}/stat'.format(pid)) as stat_file:
+                    if stat_file.read().rsplit(')', 1)[1].split()[0] == 'Z':
+                        break # killed, not reaped yet
+            except FileNotFoundError:
+                break
+            time.sleep(0.01)
+        else:
+            assert False, 'grandchild still running'
+
+    def test_exec_cmd_fast_exit(self, setup_line):
+        program = setup_line
+        return_code, stdout, _, elapsed_time = program.exec_cmd(['true'])
+        assert return_code == 0
+        assert stdout == b''
+        assert elapsed_time < 0.5
+
+    def test_exec_cmd_pipesize(self, setup_line):
+        program = setup_line
+        return_code, stdout, _, _ = program.exec_cmd(['yes'], max_pipesize=1e5)
+        assert return_code is not None
+        assert len(stdout) == 1e5
+        return_code, stdout, _, _ = program.exec_cmd(['yes'])
+        assert len(stdout) == 1e4
+        cmd = ['sh', '-c', 'yes | head -c 3000; yes >&2']
+        return_code, stdout, stderr, _ = program.exec_cmd(cmd, max_pipesize=5000)
+        assert len(stdout) + len(stderr) == 5000
+
+    def test_exec_cmd_buffer(self, setup_line, tmp_path):
+        program = setup_line
+        spill_path = str(tmp_path / 'out')
+        cmd = ['seq', '100000']
+        _, stdout, _, _ = program.exec_cmd(cmd, max_pipesize=None, buffer_size=10, spill_path=spill_path)
+        assert stdout == b'99\n100000\n'
+        with open(spill_path + '.stdout', 'rb') as spill_file:
+            assert spill_file.read().endswith(stdout)
+
     def test_evaluate_patch(self, setup_line):
         program = setup_line
         patch = Patch()
@@ -120,6 +409,144 @@ class TestLineProgram(object):
         assert run.status == 'SUCCESS'
         assert run.fitness is not None
 
+    def test_evaluate_patches(self):
+        config = {
+            'target_files': ["triangle.py"],
+            'test_command': "pytest -s test_triangle.py",
+            'nb_workers': 2,
+        }
+        program = MyLineProgram('../sample/Triangle_bug_python', config=config)
+        assert len(program.work_paths) == 2
+        patches = [Patch() for _ in range(4)]
+        results = list(program.evaluate_patches(patches))
+        assert len(results) == len(patches)
+        assert {id(patch) for patch, _ in results} == {id(patch) for patch in patches}
+        assert all(run.status == 'SUCCESS' for _, run in results)
+        assert len({run.fitness for _, run in results}) == 1
+        program.clean_work_dir()
+
+    def test_async_exec_cmd(self, setup_line):
+        program = setup_line
+        loop = asyncio.new_event_loop()
+        try:
+            return_code, stdout, _, _ = loop.run_until_complete(program.async_exec_cmd(['echo', 'hello']))
+            assert return_code == 0
+            assert stdout.decode('ascii').strip() == "hello"
+            return_code, _, _, elapsed_time = loop.run_until_complete(program.async_exec_cmd(['sleep', '5'], timeout=0.5))
+            assert return_code is None
+            assert elapsed_time < 1.5
+        finally:
+            loop.close()
+
+    def test_async_exec_cmd_pipesize(self, setup_line):
+        program = setup_line
+        loop = asyncio.new_event_loop()
+        try:
+            return_code, stdout, _, _ = loop.run_until_complete(program.async_exec_cmd(['yes'], max_pipesize=1e5))
+            assert return_code is not None
+            assert len(stdout) == 1e5
+            # stderr is still being read when stdout exceeds the limit
+            cmd = ['sh', '-c', 'yes >&2 & yes']
+            return_code, stdout, stderr, elapsed_time = loop.run_until_complete(program.async_exec_cmd(cmd, max_pipesize=5000))
+            assert return_code is not None
+            assert len(stdout) + len(stderr) == 5000
+            assert elapsed_time < 1.5
+            assert all(task.done() for task in asyncio.all_tasks(loop))
+        finally:
+            loop.close()
+
+    def test_async_evaluate_patch(self):
+        config = {
+            'target_files': ["triangle.py"],
+            'test_command': "pytest -s test_triangle.py",
+            'nb_workers': 2,
+        }
+        program = MyLineProgram('../sample/Triangle_bug_python', config=config)
+        async def evaluate_all():
+            return await asyncio.gather(*[program.async_evaluate_patch(Patch()) for _ in range(4)])
+        loop = asyncio.new_event_loop()
+        try:
+            runs = loop.run_until_complete(evaluate_all())
+        finally:
+            loop.close()
+        assert all(run.status == 'SUCCESS' for run in runs)
+        assert len({run.fitness for run in runs}) == 1
+        program.clean_work_dir()
+
+    def test_build_artifacts(self):
+        config = {
+            'target_files': ["triangle.py"],
+            'test_command': "sh -c 'if [ -f triangle.out ]; then echo 0; else cp triangle.py triangle.out; echo 1; fi'",
+            'build_artifacts': {'triangle.py': ['*.out']},
+        }
+        program = LineProgram('../sample/Triangle_bug_python', config=config)
+        deletion = Patch([LineDeletion(('triangle.py', 'line', 1))])
+        assert program.evaluate_patch(Patch()).fitness == 1
+        assert program.evaluate_patch(deletion).fitness == 1
+        assert program.evaluate_patch(Patch()).fitness == 0
+        with open(os.path.join(program.work_path, 'triangle.out')) as f:
+            with open(os.path.join(program.work_path, 'triangle.py')) as g:
+                assert f.read() == g.read()
+        assert program.evaluate_patch(deletion).fitness == 0
+        program.clean_work_dir()
+
+    def test_build_artifacts_killed(self):
+        # killed on max_pipesize or by a signal: partial artifacts are not cached
+        for command in ["sh -c 'if [ -f triangle.out ]; then echo 0; else echo 1; cp triangle.py triangle.out; yes >&2; fi'",
+                        "sh -c 'if [ -f triangle.out ]; then echo 0; else echo 1; cp triangle.py triangle.out; kill -9 $$; fi'"]:
+            config = {
+                'target_files': ["triangle.py"],
+                'test_command': command,
+                'build_artifacts': {'triangle.py': ['*.out']},
+            }
+            program = LineProgram('../sample/Triangle_bug_python', config=config)
+            assert program.evaluate_patch(Patch()).fitness == 1
+            assert program.evaluate_patch(Patch()).fitness == 1
+            assert not os.path.exists(os.path.join(program.work_dir, '__build_cache__')) or \
+                not os.listdir(os.path.join(program.work_dir, '__build_cache__'))
+            program.clean_work_dir()
+
+    def test_calibrate_timeout(self):
+        config = {
+            'target_files': ["triangle.py"],
+            'test_command': "pytest -s test_triangle.py",
+        }
+        program = MyLineProgram('../sample/Triangle_bug_python', config=config)
+        search = DummySearch()
+        search.program = program
+        search.config['warmup'] = 2
+        search.config['timeout_factor'] = 3
+        search.config['timeout_min'] = 0
+        search.run()
+        assert search.report['timeout'] == program.timeout
+        assert 0 < program.timeout < 15
+        run = program.evaluate_patch(Patch(), timeout=0.01)
+        assert run.status == 'TIMEOUT'
+        assert run.elapsed_time < 1
+        assert search.stats['timeouts'] == 0
+        program.clean_work_dir()
+
+    def test_algorithm_async_evaluate_patches(self):
+        config = {
+            'target_files': ["triangle.py"],
+            'test_command': "pytest -s test_triangle.py",
+            'nb_workers': 2,
+        }
+        program = MyLineProgram('../sample/Triangle_bug_python', config=config)
+        search = DummySearch()
+        search.program = program
+        search.reset()
+        loop = asyncio.new_event_loop()
+        try:
+            results = loop.run_until_complete(search.async_evaluate_patches([Patch(), Patch()]))
+            assert all(run.status == 'SUCCESS' for _, run in results)
+            hits = search.stats['cache_hits']
+            loop.run_until_complete(search.async_evaluate_patches([Patch()]))
+            assert search.stats['cache_hits'] == hits + 1
+        finally:
+            loop.close()
+            program.clean_work_dir()
+
     def test_remove_tmp_variant(self, setup_line):
         program = setup_line
         program.remove_tmp_variant()
@@ -170,6 +597,15 @@ class TestTreeProgram(object):
         patch.add(StmtInsertion(('triangle.py', 'stmt', 1), ('triangle.py', 'stmt', 10)))
         assert program.diff(patch).strip()
 
+    def test_variant_key(self, setup_tree):
+        program = setup_tree
+        patch = Patch([StmtInsertion(('triangle.py', 'stmt', 1), ('triangle.py', 'stmt', 10))])
+        same = Patch([StmtInsertion(('triangle.py', 'stmt', 1), ('triangle.py', 'stmt', 10))])
+        assert program.get_modified_dumps(patch) is program.get_modified_dumps(same)
+        assert program.variant_key(patch) == program.variant_key(same)
+        assert program.variant_key(patch) != program.variant_key(Patch())
+        assert program.get_modified_dumps(patch) == program.dump_contents(program.get_modified_contents(patch))
+
     def test_exec_cmd(self, setup_tree):
         program = setup_tree
         _, stdout, _, _ = program.exec_cmd(['echo', 'hello'])
@@ -182,6 +618,26 @@ class TestTreeProgram(object):
         assert run.status == 'SUCCESS'
         assert run.fitness is not None
 
+    def test_validate(self, setup_tree):
+        program = setup_tree
+        locations = program.locations['triangle.py']
+        engine = program.engines['triangle.py']
+        def is_return(pos):
+            block, index = engine.pos_2_block_n_index(program.contents['triangle.py'], pos)
+            return isinstance(block[index], ast.Return)
+        stmt = next(i for i, pos in enumerate(locations['stmt']) if is_return(pos))
+        block = next(i for i, pos in enumerate(locations['_inter_block']) if len(pos) == 1)
+        patch = Patch([StmtInsertion(('triangle.py', '_inter_block', block), ('triangle.py', 'stmt', stmt))])
+        program.validate = True
+        try:
+            program.remove_tmp_variant()
+            run = program.evaluate_patch(patch)
+            assert run.status == 'INVALID'
+            assert not os.path.exists(program.work_path)
+            assert program.evaluate_patch(Patch()).status == 'SUCCESS'
+        finally:
+            program.validate = False
+
     def test_remove_tmp_variant(self, setup_tree):
         program = setup_tree
         program.remove_tmp_variant()
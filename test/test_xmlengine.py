@@ -1,8 +1,13 @@
 import copy
+import inspect
 import os
 import pytest
+import shutil
+import sys
 
-from pyggi.tree import XmlEngine
+import pyggi
+
+from pyggi.tree import XmlEngine, SrcmlEngine
 from util import assert_diff
 
 @pytest.fixture
@@ -197,3 +202,130 @@ def test_insertion3(engine_contents, engine_locations):
              a = b;
 """
     assert_diff(dump, new_dump, expected)
+
+def test_insertion4(engine_contents, engine_locations):
+    """Nested locations should still be found after insertions"""
+    file_name = 'Triangle.java.xml'
+    new_contents = copy.deepcopy(engine_contents)
+    new_locations = copy.deepcopy(engine_locations)
+    target1 = (file_name, '_inter_block', 10)
+    target2 = (file_name, 'expr_stmt', 1)
+    target3 = (file_name, '_inter_block', 0)
+    assert XmlEngine.do_insert(engine_contents, engine_locations, new_contents, new_locations, target1, target2)
+    assert XmlEngine.do_insert(engine_contents, engine_locations, new_contents, new_locations, target3, target2)
+    assert new_locations[file_name] != engine_locations[file_name]
+    index, new_index = engine_locations[file_name], new_locations[file_name]
+    for tag in ['expr_stmt', 'comment']:
+        for path in index[tag]:
+            node = index.find(engine_contents[file_name], path)
+            new_node = new_index.find(new_contents[file_name], path)
+            assert XmlEngine.tree_to_string(node) == XmlEngine.tree_to_string(new_node)
+
+def test_insertion_points(engine_contents, engine_locations):
+    """Insertion points should be computed from the numbers of children"""
+    file_name = 'Triangle.java.xml'
+    points = engine_locations[file_name]['_inter_block']
+    expected = []
+    for path in engine_locations[file_name]['block']:
+        node = engine_locations[file_name].find(engine_contents[file_name], path)
+        expected.extend((path, i) for i in range(len(node)+1))
+    assert len(points) == len(expected)
+    assert points == expected
+    assert [points[i] for i in range(len(points))] == expected
+    assert points[-1] == expected[-1]
+
+def test_lxml(engine_contents):
+    """lxml trees should be identical to ElementTree ones"""
+    pytest.importorskip('lxml')
+    class LxmlEngine(XmlEngine):
+        USE_LXML = True
+    file_name = 'Triangle.java.xml'
+    path = os.path.join('test_src', file_name)
+    contents = {file_name: LxmlEngine.get_contents(path)}
+    def walk(node):
+        return (node.tag, node.text, node.tail, dict(node.attrib), [walk(child) for child in node])
+    assert type(contents[file_name]).__module__.startswith('lxml')
+    assert walk(contents[file_name]) == walk(engine_contents[file_name])
+    locations = {file_name: LxmlEngine.get_locations(contents[file_name])}
+    new_contents = copy.deepcopy(contents)
+    new_locations = copy.deepcopy(locations)
+    target1 = (file_name, '_inter_block', 10)
+    target2 = (file_name, 'expr_stmt', 1)
+    target3 = (file_name, 'expr_stmt', 0)
+    target4 = (file_name, 'comment', 0)
+    assert LxmlEngine.do_insert(contents, locations, new_contents, new_locations, target1, target2)
+    assert LxmlEngine.do_replace(contents, locations, new_contents, new_locations, target3, target4)
+    assert not LxmlEngine.do_replace(contents, locations, new_contents, new_locations, target3, target4)
+    expected = """--- 
++++ 
+@@ -6,7 +6,9 @@
+ 
+     public static TriangleType classifyTriangle(int a, int b, int c) {
+ 
+-        delay();
++        // Sort the sides so that a <= b <= c
++
++        a = b;
+ 
+         // Sort the sides so that a <= b <= c
+         if (a > b) {
+"""
+    assert_diff(LxmlEngine.dump(contents[file_name]), LxmlEngine.dump(new_contents[file_name]), expected)
+
+def test_process_tree():
+    """srcML trees should be processed in a single pass"""
+    xml = ('<unit><if>if (<expr><name>a</name> <operator>==</operator> <literal type="number">1</literal></expr>)'
+           '<block type="pseudo">\n    <expr_stmt><expr><name>a</name><operator>++</operator></expr>;</expr_stmt></block></if>\n</unit>')
+    tree = SrcmlEngine.string_to_tree(xml)
+    SrcmlEngine.process_tree(tree)
+    assert SrcmlEngine.tree_to_string(tree) == ('<unit><stmt>if (a <operator_comp>==</operator_comp> <number>1</number>)'
+                                                '<block>/*auto*/{\n    <stmt>a++;</stmt>\n}/*auto*/</block></stmt>\n</unit>')
+
+def test_process_tree_deep():
+    """Deep trees should not hit the recursion limit"""
+    xml = '<unit>' + '<block>{<expr_stmt><expr>'*2000 + 'x' + '</expr></expr_stmt>}</block>'*2000 + '</unit>'
+    tree = SrcmlEngine.string_to_tree(xml)
+    SrcmlEngine.process_tree(tree)
+    assert SrcmlEngine.dump(tree) == '{'*2000 + 'x' + '}'*2000
+    assert SrcmlEngine.count_tags(tree) == {'unit': 1, 'block': 2000, 'stmt': 2000}
+    locations = SrcmlEngine.get_locations(tree)
+    assert len(locations['stmt']) == 2000
+    assert len(locations['_inter_block']) == 2*2000
+
+def test_srcml(tmp_path, monkeypatch):
+    """Missing srcML files should be converted at once, then cached"""
+    monkeypatch.setattr(pyggi.config, 'cache_dir', str(tmp_path / 'cache'))
+    monkeypatch.setenv('SRCML_LOG', str(tmp_path / 'srcml.log'))
+    class MySrcmlEngine(SrcmlEngine):
+        SRCML_COMMAND = '{} {}'.format(sys.executable, os.path.abspath(os.path.join('test_src', 'srcml')))
+        CACHE = True
+    paths = []
+    for name in ['Triangle.java', 'Other.java']:
+        shutil.copy(os.path.join('test_src', 'Triangle.java'), str(tmp_path / name))
+        paths.append(str(tmp_path / '{}.xml'.format(name)))
+    with open(os.path.join('test_src', 'Triangle.java')) as source_file:
+        source = source_file.read()
+    contents = MySrcmlEngine.get_contents_batch(paths)
+    assert [MySrcmlEngine.dump(tree) for tree in contents] == [source, source]
+    assert len(MySrcmlEngine.get_locations(contents[0])['stmt']) > 0
+    with open(str(tmp_path / 'srcml.log')) as log_file:
+        assert log_file.read().splitlines() == [' '.join(path[:-4] for path in paths)]
+
+    monkeypatch.setattr(MySrcmlEngine, 'process_tree', None) # not run anymore
+    contents2 = MySrcmlEngine.get_contents_batch(paths)
+    assert [MySrcmlEngine.tree_to_string(tree) for tree in contents2] == \
+        [MySrcmlEngine.tree_to_string(tree) for tree in contents]
+    with open(str(tmp_path / 'srcml.log')) as log_file:
+        assert len(log_file.read().splitlines()) == 1
+
+def test_process_key(monkeypatch):
+    """Cached trees should depend on the processing options and code"""
+    key = SrcmlEngine.process_key()
+    assert key == SrcmlEngine.process_key()
+    monkeypatch.setattr(SrcmlEngine, 'PROCESS_LITERALS', False)
+    assert SrcmlEngine.process_key() != key
+    monkeypatch.undo()
+    monkeypatch.setattr(XmlEngine, '_code_keys', {})
+    monkeypatch.setattr(inspect, 'getsource', lambda obj: 'class {}: pass'.format(obj.__name__))
+    assert SrcmlEngine.process_key() != key
+    assert not SrcmlEngine.CACHE